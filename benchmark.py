@@ -0,0 +1,211 @@
+import gc
+import sys
+import time
+import tracemalloc
+from browser import HTMLParser, CSSParser, RuleIndex, INHERITED_PROPERTIES
+from browser import style, cascade_priority
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def make_page(paragraphs):
+    out = "<!doctype html><html><head><title>Benchmark</title></head><body>"
+    for i in range(paragraphs):
+        out += f"<div class=item id=p{i}><p>Paragraph {i} has "
+        out += "some fairly long running text &amp; entities " * 20
+        out += f"<b>bold {i}</b> <i>italic</i> <input name=f{i} value=v{i}></p></div>\n"
+    out += "</body></html>"
+    return out
+
+class LegacyHTMLParser(HTMLParser):
+    # The original per-character tokenizer, kept for comparison
+    def parse(self):
+        text = ""
+        in_tag = False
+        for c in self.body:
+            if c == "<":
+                in_tag = True
+                if text: self.add_text(text)
+                text = ""
+            elif c == ">":
+                in_tag = False
+                self.add_tag(text)
+                text = ""
+            else:
+                text += c
+        if not in_tag and text:
+            self.add_text(text)
+        return self.finish()
+
+class TokensOnly:
+    # Discard tokens so that only the tokenizer itself is timed
+    def add_text(self, text): pass
+    def add_tag(self, tag): pass
+    def finish(self): pass
+
+class LegacyTokenizer(TokensOnly, LegacyHTMLParser): pass
+class Tokenizer(TokensOnly, HTMLParser): pass
+
+def bench_html():
+    body = make_page(2000)
+    print(f"HTML parsing of {len(body) / 1e6:.1f} MB")
+    legacy, _ = timed(lambda: LegacyTokenizer(body).parse())
+    scanning, _ = timed(lambda: Tokenizer(body).parse())
+    print(f"  tokenize, per-character: {legacy * 1000:8.1f} ms")
+    print(f"  tokenize, scanning:      {scanning * 1000:8.1f} ms  ({legacy / scanning:.1f}x)")
+
+    legacy, _ = timed(lambda: LegacyHTMLParser(body).parse())
+    scanning, _ = timed(lambda: HTMLParser(body).parse())
+    print(f"  full parse, per-character: {legacy * 1000:8.1f} ms")
+    print(f"  full parse, scanning:      {scanning * 1000:8.1f} ms  ({legacy / scanning:.1f}x)")
+
+    def streamed():
+        parser = HTMLParser()
+        for i in range(0, len(body), 64 * 1024):
+            parser.feed(body[i:i + 64 * 1024])
+        return parser.finish()
+    chunked, _ = timed(streamed)
+    print(f"  full parse, 64 KB chunks:  {chunked * 1000:8.1f} ms  ({legacy / chunked:.1f}x)")
+
+def make_stylesheet(rules):
+    out = ""
+    for i in range(rules):
+        kind = i % 5
+        if kind == 0:
+            out += f".c{i} {{ color: red; }}\n"
+        elif kind == 1:
+            out += f"#p{i} {{ font-weight: bold; }}\n"
+        elif kind == 2:
+            out += f"div .c{i} {{ font-style: italic; }}\n"
+        elif kind == 3:
+            out += f"div.item b.c{i} {{ color: blue; }}\n"
+        else:
+            out += f"section p span{i} {{ font-size: 90%; }}\n"
+    out += "p { color: black; }\ndiv p b { font-weight: bold; }\n"
+    return out
+
+def legacy_style(node, rules):
+    # The original cascade: every rule is tested against every node
+    node.style = {}
+    for property, default_value in INHERITED_PROPERTIES.items():
+        if node.parent:
+            node.style[property] = node.parent.style[property]
+        else:
+            node.style[property] = default_value
+    for selector, body in rules:
+        if not selector.matches(node): continue
+        for property, value in body.items():
+            node.style[property] = value
+    if node.style["font-size"].endswith("%"):
+        parent_font_size = node.parent.style["font-size"] if node.parent \
+            else INHERITED_PROPERTIES["font-size"]
+        node_pct = float(node.style["font-size"][:-1]) / 100
+        node.style["font-size"] = str(node_pct * float(parent_font_size[:-2])) + "px"
+    for child in node.children:
+        legacy_style(child, rules)
+
+def bench_style():
+    nodes = HTMLParser(make_page(200)).parse()
+    rules = sorted(CSSParser(make_stylesheet(3000)).parse(), key=cascade_priority)
+    print(f"Style cascade, {len(rules)} rules")
+    legacy, _ = timed(lambda: legacy_style(nodes, rules), repeat=1)
+    expected = [dict(node.style) for node in tree(nodes)]
+    print(f"  every rule per node: {legacy * 1000:8.1f} ms")
+    index = RuleIndex(rules)
+    indexed, _ = timed(lambda: style(nodes, index, force=True))
+    assert [node.style for node in tree(nodes)] == expected
+    print(f"  bucketed + bloom:    {indexed * 1000:8.1f} ms  ({legacy / indexed:.1f}x)")
+
+def tree(node, out=None):
+    if out is None: out = []
+    out.append(node)
+    for child in node.children:
+        tree(child, out)
+    return out
+
+def dict_backed(cls):
+    # The same class without __slots__, for comparison
+    namespace = {name: value for name, value in vars(cls).items()
+        if name != "__slots__" and name not in cls.__slots__}
+    return type(cls.__name__, (), namespace)
+
+def commands(display_list):
+    return sum(1 + commands(cmd.children) if hasattr(cmd, "children") else 1
+        for cmd in display_list)
+
+def traced(fn):
+    # Bytes still allocated, and objects the collector tracks, once fn returns
+    gc.collect()
+    objects = len(gc.get_objects())
+    tracemalloc.start()
+    result = fn()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    return size, len(gc.get_objects()) - objects, result
+
+def bench_memory():
+    import browser
+    import ui
+    body = make_page(1000)
+    rules = sorted(ui.DEFAULT_STYLE_SHEET, key=cascade_priority)
+
+    def build():
+        stages = {}
+        size, objects, nodes = traced(lambda: HTMLParser(body).parse())
+        stages["DOM"] = (size, objects, len(tree(nodes)))
+        style(nodes, RuleIndex(rules), force=True)
+        document = ui.DocumentLayout(nodes, ui.WIDTH)
+        size, objects, _ = traced(document.layout)
+        stages["layout"] = (size, objects, len(tree(document)))
+        def paint():
+            display_list = []
+            ui.paint_tree(document, display_list)
+            return ui.optimize_display_list(display_list)
+        size, objects, display_list = traced(paint)
+        stages["display list"] = (size, objects, commands(display_list))
+        return stages
+
+    classes = [(browser, "Text"), (browser, "Element"),
+        (ui, "Text"), (ui, "Element"),
+        (ui, "BlockLayout"), (ui, "LineLayout"), (ui, "TextLayout"),
+        (ui, "InputLayout"), (ui, "DrawLine"), (ui, "DrawOutline"),
+        (ui, "DrawText"), (ui, "DrawTextRun"), (ui, "DrawRRect"),
+        (ui, "Opacity"), (ui, "Blend")]
+    slotted = [getattr(module, name) for module, name in classes]
+    unslotted = {cls: dict_backed(cls) for cls in slotted}
+
+    build()  # fill the font and text measurement caches first
+    for (module, name), cls in zip(classes, slotted):
+        setattr(module, name, unslotted[cls])
+    try:
+        legacy = build()
+    finally:
+        for (module, name), cls in zip(classes, slotted):
+            setattr(module, name, cls)
+    compact = build()
+
+    print(f"Memory for a {len(body) / 1e6:.1f} MB page")
+    for stage, (size, objects, count) in compact.items():
+        legacy_size, legacy_objects, _ = legacy[stage]
+        print(f"  {stage + ',':13} {count:6} objects")
+        print(f"    __dict__:  {legacy_size / 1e6:6.1f} MB  {legacy_size / count:5.0f} B/object  {legacy_objects:7} GC objects")
+        print(f"    __slots__: {size / 1e6:6.1f} MB  {size / count:5.0f} B/object  {objects:7} GC objects  ({legacy_size / size:.1f}x)")
+
+BENCHMARKS = {
+    "html": bench_html,
+    "style": bench_style,
+    "memory": bench_memory,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -2,6 +2,14 @@ import socket
 import ssl
 import os
 import html
+import threading
+import time
+import json
+import codecs
+import re
+import heapq
+import hashlib
+from collections import OrderedDict
 
 INHERITED_PROPERTIES = {
     "font-size": "16px",
@@ -11,6 +19,365 @@ INHERITED_PROPERTIES = {
     "text-align": "left",
 }
 COOKIE_JAR = {}
+MAX_CONNECTIONS_PER_HOST = 6
+IDLE_CONNECTION_TIMEOUT = 30
+CONNECTION_WAIT_TIMEOUT = 30
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nabin-browser")
+MEMORY_CACHE_BYTES = 16 * 1024 * 1024
+DISK_CACHE_BYTES = 64 * 1024 * 1024
+READ_BLOCK_SIZE = 64 * 1024
+TAG_TOKENS = re.compile("([^<>]*)([<>])")
+BLOOM_BITS = 256
+
+class Connection:
+    def __init__(self, scheme, host, port):
+        s = socket.socket()
+        s.connect((host, port))
+        if scheme == 'https':
+            ctx = ssl.create_default_context()
+            s = ctx.wrap_socket(s, server_hostname=host)
+        self.socket = s
+        self.response = s.makefile("rb")
+        self.reused = False
+        self.received_body = False
+        self.last_used = time.monotonic()
+
+    def send(self, request, stream=None):
+        self.received_body = False
+        self.socket.sendall(request.encode("utf8"))
+
+        statusline = self.response.readline().decode("utf8")
+        if not statusline:
+            raise ConnectionError("Connection closed by server")
+        version, status, explanation = statusline.split(" ", 2)
+        status = int(status)
+
+        response_headers = {}
+        while True:
+            line = self.response.readline().decode("utf8")
+            if line in ("\r\n", "\n", ""):
+                break
+            header, value = line.split(":", 1)
+            response_headers[header.casefold()] = value.strip()
+
+        connection = response_headers.get("connection", "").casefold()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        if status in (204, 304) or 100 <= status < 200:
+            blocks = []
+        elif response_headers.get("transfer-encoding", "").casefold() == "chunked":
+            blocks = self.read_chunked()
+        elif "content-length" in response_headers:
+            blocks = self.read_exactly(int(response_headers["content-length"]))
+        else:
+            blocks = self.read_until_close()
+            keep_alive = False
+
+        decoder = codecs.getincrementaldecoder("utf8")()
+        parts = []
+        for block in blocks:
+            self.received_body = True
+            text = decoder.decode(block)
+            if text:
+                parts.append(text)
+                if stream: stream(text)
+        text = decoder.decode(b"", final=True)
+        if text:
+            parts.append(text)
+            if stream: stream(text)
+
+        return status, response_headers, "".join(parts), keep_alive
+
+    def read_exactly(self, length):
+        while length > 0:
+            block = self.response.read1(min(length, READ_BLOCK_SIZE))
+            if not block:
+                raise ConnectionError("Connection closed mid-body")
+            length -= len(block)
+            yield block
+
+    def read_until_close(self):
+        while True:
+            block = self.response.read1(READ_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+
+    def read_chunked(self):
+        while True:
+            line = self.response.readline()
+            if not line:
+                raise ConnectionError("Connection closed mid-chunk")
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                break
+            yield from self.read_exactly(size)
+            self.response.readline()
+        # Skip any trailer headers up to the terminating blank line
+        while True:
+            line = self.response.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+    def close(self):
+        try:
+            self.response.close()
+            self.socket.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST,
+                 idle_timeout=IDLE_CONNECTION_TIMEOUT,
+                 wait_timeout=CONNECTION_WAIT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.idle = {}
+        self.in_use = {}
+        self.lock = threading.Condition()
+
+    def acquire(self, key):
+        with self.lock:
+            self.evict_idle()
+            while True:
+                idle = self.idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                    conn.reused = True
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    return conn
+                if self.in_use.get(key, 0) < self.max_per_host:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    break
+                if not self.lock.wait(self.wait_timeout):
+                    raise TimeoutError(
+                        "No free connection to {}:{}".format(key[1], key[2]))
+        try:
+            return Connection(*key)
+        except BaseException:
+            with self.lock:
+                self.in_use[key] -= 1
+                self.lock.notify_all()
+            raise
+
+    def release(self, key, conn, reusable):
+        with self.lock:
+            self.in_use[key] -= 1
+            if reusable:
+                conn.last_used = time.monotonic()
+                self.idle.setdefault(key, []).append(conn)
+            else:
+                conn.close()
+            self.lock.notify_all()
+
+    def discard(self, key):
+        with self.lock:
+            for conn in self.idle.pop(key, []):
+                conn.close()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for key, conns in list(self.idle.items()):
+            fresh = []
+            for conn in conns:
+                if now - conn.last_used > self.idle_timeout:
+                    conn.close()
+                else:
+                    fresh.append(conn)
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+
+    def close_all(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+CONNECTION_POOL = ConnectionPool()
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().casefold()
+        if not directive: continue
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip()] = arg.strip().strip('"')
+        else:
+            directives[directive] = None
+    return directives
+
+class CacheEntry:
+    def __init__(self, headers, content, stored_at):
+        self.headers = headers
+        self.content = content
+        self.stored_at = stored_at
+        self.size = len(content.encode("utf8")) + \
+            sum(len(k) + len(v) for k, v in headers.items())
+
+    def max_age(self):
+        directives = parse_cache_control(self.headers.get("cache-control", ""))
+        if "no-cache" in directives:
+            return 0
+        try:
+            max_age = int(directives.get("max-age") or 0)
+            age = int(self.headers.get("age", "0"))
+        except ValueError:
+            return 0
+        return max_age - age
+
+    def is_fresh(self):
+        return time.time() - self.stored_at < self.max_age()
+
+class HTTPCache:
+    def __init__(self, directory=CACHE_DIR, memory_budget=MEMORY_CACHE_BYTES,
+                 disk_budget=DISK_CACHE_BYTES):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        # Bytes of cache files on disk, counted on the first save
+        self.disk_size = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        entry = self.load(key)
+        if entry:
+            with self.lock:
+                self.remember(key, entry)
+        return entry
+
+    def store(self, key, status, headers, content):
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        cacheable = status == 200 and "no-store" not in directives \
+            and "private" not in directives and "set-cookie" not in headers \
+            and "vary" not in headers \
+            and ("max-age" in directives or "etag" in headers
+                 or "last-modified" in headers)
+        if not cacheable:
+            self.forget(key)
+            return
+        entry = CacheEntry(headers, content, time.time())
+        with self.lock:
+            self.remember(key, entry)
+        self.save(key, entry)
+
+    def revalidated(self, key, entry, headers):
+        merged = dict(entry.headers)
+        for header in ["cache-control", "etag", "last-modified", "expires", "age", "date"]:
+            if header in headers:
+                merged[header] = headers[header]
+        entry = CacheEntry(merged, entry.content, time.time())
+        with self.lock:
+            self.remember(key, entry)
+        self.save(key, entry)
+        return entry
+
+    def forget(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory_size -= self.memory.pop(key).size
+        try:
+            size = os.path.getsize(self.path(key))
+            os.remove(self.path(key))
+        except OSError:
+            return
+        with self.lock:
+            if self.disk_size is not None:
+                self.disk_size -= size
+
+    def remember(self, key, entry):
+        if key in self.memory:
+            self.memory_size -= self.memory.pop(key).size
+        if entry.size > self.memory_budget:
+            return
+        self.memory[key] = entry
+        self.memory_size += entry.size
+        while self.memory_size > self.memory_budget:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= evicted.size
+
+    def path(self, key):
+        name = hashlib.sha256(key.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                data = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if data.get("key") != key:
+            return None
+        return CacheEntry(data["headers"], data["content"], data["stored_at"])
+
+    def save(self, key, entry):
+        data = {
+            "key": key,
+            "headers": entry.headers,
+            "content": entry.content,
+            "stored_at": entry.stored_at,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = "{}.{}.tmp".format(self.path(key), threading.get_ident())
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump(data, f)
+            size = os.path.getsize(tmp)
+            try:
+                replaced = os.path.getsize(self.path(key))
+            except OSError:
+                replaced = 0
+            os.replace(tmp, self.path(key))
+            with self.lock:
+                if self.disk_size is None:
+                    self.disk_size = sum(size for _, size, _ in self.disk_files())
+                else:
+                    self.disk_size += size - replaced
+                over_budget = self.disk_size > self.disk_budget
+            if over_budget:
+                self.trim_disk()
+        except OSError:
+            pass
+
+    def disk_files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"): continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def trim_disk(self):
+        files = self.disk_files()
+        total = sum(size for _, size, _ in files)
+        # Least recently used files have the oldest mtime
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_budget: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        with self.lock:
+            self.disk_size = total
+
+HTTP_CACHE = HTTPCache()
 
 class URL:
     def __init__(self, url):
@@ -70,66 +437,73 @@ class URL:
             return "null"
         return self.scheme + "://" + self.host + ":" + str(self.port)
 
-    def request(self, referrer, payload=None):
+    def request(self, referrer, payload=None, stream=None):
+        # If given, stream is called with each decoded piece of the body
+        # as it arrives, ahead of the full body being returned.
         method = "POST" if payload else "GET"
-        if self.scheme == "file":
-            path = self.path
-            if os.path.isfile(path):
-                with open(path, "r", encoding="utf8") as f:
-                    return {}, f.read()
-            elif os.path.isdir(path):
-                return {}, self.generate_directory_listing(path)
-            else:
-                return {}, f"<html><body><h1>Error</h1><p>Path not found: {path}</p></body></html>"
-        
-        if self.scheme == "data":
-            return {}, self.path.split(",", 1)[1]
+        if self.scheme in ("file", "data", "about"):
+            content = self.read_local()
+            if stream: stream(content)
+            return {}, content
 
-        if self.scheme == "about":
-            return {}, ""
-
-        s = socket.socket()
+        cookie = None
+        if self.host in COOKIE_JAR:
+            cookie, params = COOKIE_JAR[self.host]
+            if referrer and params.get("samesite", "none") == "lax":
+                if method != "GET" and self.host != referrer.host:
+                    cookie = None
 
-        s.connect((self.host, self.port))
+        # The cache is keyed on the URL alone, so responses that may
+        # depend on the session's cookie bypass it
+        cache_key = self.origin() + self.path
+        use_cache = method == "GET" and cookie is None
+        cached = HTTP_CACHE.get(cache_key) if use_cache else None
+        if cached and cached.is_fresh():
+            if stream: stream(cached.content)
+            return cached.headers, cached.content
 
-        if self.scheme == 'https':
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
-        
-        request = f"{method} {self.path} HTTP/1.0\r\n"
+        request = f"{method} {self.path} HTTP/1.1\r\n"
         request += f"HOST: {self.host}\r\n"
         if payload:
             length = len(payload.encode("utf8"))
             request += f"Content-Length: {length}\r\n"
+        if cookie is not None:
+            request += f"Cookie: {cookie}\r\n"
 
-        if self.host in COOKIE_JAR:
-            cookie, params = COOKIE_JAR[self.host]
-            allow_cookie = True
-            if referrer and params.get("samesite", "none") == "lax":
-                if method != "GET":
-                    allow_cookie = self.host == referrer.host
-            if allow_cookie:
-                request += f"Cookie: {cookie}\r\n"
+        if cached:
+            if "etag" in cached.headers:
+                request += f"If-None-Match: {cached.headers['etag']}\r\n"
+            if "last-modified" in cached.headers:
+                request += f"If-Modified-Since: {cached.headers['last-modified']}\r\n"
 
-        request += "Connection: close\r\n"
+        request += "Connection: keep-alive\r\n"
         request += "User-Agent: Nabin\r\n"
         request += "\r\n"
         if payload:
             request += payload
-        s.send(request.encode("utf8"))
-
-        response = s.makefile("r", encoding="utf8", newline="\r\n")
-        
-        statusline = response.readline()
-        version, status, explanation = statusline.split(" ", 2)
 
-        response_headers = {}
-        while True:
-            line = response.readline()
-            if line == "\r\n":
-                break
-            header, value = line.split(":", 1)
-            response_headers[header.casefold()] = value.strip()
+        key = (self.scheme, self.host, self.port)
+        conn = CONNECTION_POOL.acquire(key)
+        try:
+            status, response_headers, content, reusable = conn.send(request, stream)
+        except (OSError, ConnectionError):
+            CONNECTION_POOL.release(key, conn, False)
+            if method != "GET" or not conn.reused or conn.received_body:
+                raise
+            # The server may have dropped an idle keep-alive connection,
+            # so retry once on a freshly opened socket.
+            CONNECTION_POOL.discard(key)
+            conn = CONNECTION_POOL.acquire(key)
+            try:
+                status, response_headers, content, reusable = conn.send(request, stream)
+            except BaseException:
+                CONNECTION_POOL.release(key, conn, False)
+                raise
+        except BaseException:
+            # A malformed response leaves the socket mid-message
+            CONNECTION_POOL.release(key, conn, False)
+            raise
+        CONNECTION_POOL.release(key, conn, reusable)
 
         if "set-cookie" in response_headers:
             cookie = response_headers["set-cookie"]
@@ -144,11 +518,35 @@ class URL:
                     params[param.strip().casefold()] = value.casefold()
             COOKIE_JAR[self.host] = (cookie, params)
 
-        content = response.read()
-        s.close()
+        if cached and status == 304:
+            cached = HTTP_CACHE.revalidated(cache_key, cached, response_headers)
+            if stream: stream(cached.content)
+            return cached.headers, cached.content
+        if use_cache:
+            HTTP_CACHE.store(cache_key, status, response_headers, content)
+        elif method == "POST":
+            # The stored page may be out of date once the server has
+            # handled a form submission to it
+            HTTP_CACHE.forget(cache_key)
 
         return response_headers, content
 
+    def read_local(self):
+        if self.scheme == "file":
+            path = self.path
+            if os.path.isfile(path):
+                with open(path, "r", encoding="utf8") as f:
+                    return f.read()
+            elif os.path.isdir(path):
+                return self.generate_directory_listing(path)
+            else:
+                return f"<html><body><h1>Error</h1><p>Path not found: {path}</p></body></html>"
+
+        if self.scheme == "data":
+            return self.path.split(",", 1)[1]
+
+        return ""
+
     def generate_directory_listing(self, path):
         path = os.path.abspath(path)
         
@@ -232,7 +630,24 @@ class URL:
         return self.scheme + "://" + self.host + port_part + self.path + fragment_part
     
 # functions
-def style(node, rules):
+def style(node, rules, force=False, ancestors=0):
+    # Only dirty nodes are restyled; clean subtrees are skipped unless an
+    # ancestor's computed style changed underneath them.
+    if force or node.style_dirty:
+        old_style = node.style
+        compute_style(node, rules, ancestors)
+        node.style_dirty = False
+        if node.style != old_style:
+            mark_layout_dirty(node)
+            force = True
+
+    if force or node.children_dirty:
+        ancestors |= bloom_bits(node)
+        for child in node.children:
+            style(child, rules, force, ancestors)
+        node.children_dirty = False
+
+def compute_style(node, rules, ancestors=None):
     node.style = {}
     for property, default_value in INHERITED_PROPERTIES.items():
         if node.parent:
@@ -240,8 +655,8 @@ def style(node, rules):
         else:
             node.style[property] = default_value
 
-    for selector, body in rules:
-        if not selector.matches(node): continue
+    for _, selector, body in rules.candidates(node):
+        if not selector.matches(node, ancestors): continue
         for property, value in body.items():
             node.style[property] = value
 
@@ -259,8 +674,157 @@ def style(node, rules):
         parent_px = float(parent_font_size[:-2])
         node.style["font-size"] = str(node_pct * parent_px) + "px"
 
+def bloom_bit(key):
+    # Two bits per key out of BLOOM_BITS, taken from one hash
+    h = hash(key)
+    return (1 << (h % BLOOM_BITS)) | (1 << ((h >> 16) % BLOOM_BITS))
+
+def bloom_bits(node):
+    if not isinstance(node, Element):
+        return 0
+    bits = bloom_bit(node.tag)
+    if "id" in node.attributes:
+        bits |= bloom_bit("#" + node.attributes["id"])
+    for classname in node.attributes.get("class", "").split():
+        bits |= bloom_bit("." + classname)
+    return bits
+
+class RuleIndex:
+    def __init__(self, rules):
+        # rules must already be in cascade order; each entry remembers its
+        # position so candidates from different buckets merge back in order
+        self.ids = {}
+        self.classes = {}
+        self.tags = {}
+        self.universal = []
+        for position, (selector, body) in enumerate(rules):
+            entry = (position, selector, body)
+            kind, key = selector.bucket()
+            if kind == "id":
+                self.ids.setdefault(key, []).append(entry)
+            elif kind == "class":
+                self.classes.setdefault(key, []).append(entry)
+            elif kind == "tag":
+                self.tags.setdefault(key, []).append(entry)
+            else:
+                self.universal.append(entry)
+
+    def candidates(self, node):
+        if not isinstance(node, Element):
+            return ()
+        buckets = []
+        if self.universal:
+            buckets.append(self.universal)
+        if node.tag in self.tags:
+            buckets.append(self.tags[node.tag])
+        if node.attributes.get("id") in self.ids:
+            buckets.append(self.ids[node.attributes["id"]])
+        for classname in set(node.attributes.get("class", "").split()):
+            if classname in self.classes:
+                buckets.append(self.classes[classname])
+        if len(buckets) == 1:
+            return buckets[0]
+        return heapq.merge(*buckets)
+
+class NodeIndex:
+    def __init__(self):
+        # Elements by id, class and tag. The parser adds them in document
+        # order; buckets that later get nodes out of order are re-sorted
+        # the next time they are queried.
+        self.root = None
+        self.buckets = {"id": {}, "class": {}, "tag": {}}
+        self.unordered = set()
+        self.positions = None
+
+    def keys(self, node):
+        yield "tag", node.tag
+        if "id" in node.attributes:
+            yield "id", node.attributes["id"]
+        for classname in node.attributes.get("class", "").split():
+            yield "class", classname
+
+    def add(self, node):
+        self.buckets["tag"].setdefault(node.tag, {})[node] = None
+        attributes = node.attributes
+        if attributes:
+            if "id" in attributes:
+                self.buckets["id"].setdefault(attributes["id"], {})[node] = None
+            if "class" in attributes:
+                for classname in attributes["class"].split():
+                    self.buckets["class"].setdefault(classname, {})[node] = None
+
+    def add_tree(self, node):
+        if not isinstance(node, Element): return
+        self.add(node)
+        self.unordered.update(self.keys(node))
+        self.positions = None
+        for child in node.children:
+            self.add_tree(child)
+
+    def remove_tree(self, node):
+        if not isinstance(node, Element): return
+        for kind, key in self.keys(node):
+            nodes = self.buckets[kind].get(key)
+            if nodes is None: continue
+            nodes.pop(node, None)
+            if not nodes:
+                del self.buckets[kind][key]
+        self.positions = None
+        for child in node.children:
+            self.remove_tree(child)
+
+    def candidates(self, selector):
+        # Elements that could match, in document order; None means any
+        # element could
+        kind, key = selector.bucket()
+        if kind not in self.buckets:
+            return None
+        nodes = self.buckets[kind].get(key)
+        if nodes is None:
+            return []
+        if (kind, key) in self.unordered:
+            self.unordered.discard((kind, key))
+            if self.positions is None:
+                self.positions = {}
+                self.number(self.root)
+            # Anything no longer under the root has left the document
+            nodes = self.buckets[kind][key] = dict.fromkeys(
+                sorted((node for node in nodes if node in self.positions),
+                    key=self.positions.__getitem__))
+        return list(nodes)
+
+    def contains(self, node):
+        while node.parent:
+            node = node.parent
+        return node is self.root
+
+    def number(self, node):
+        self.positions[node] = len(self.positions)
+        for child in node.children:
+            self.number(child)
+
+def mark_dirty(node):
+    node.style_dirty = True
+    node.children_dirty = True
+    mark_layout_dirty(node)
+    while node.parent and not node.parent.children_dirty:
+        node = node.parent
+        node.children_dirty = True
+
+def mark_layout_dirty(node):
+    # Layout is redone for every block whose node is flagged, so the flag
+    # has to reach the root along with any change beneath it.
+    while node and not node.layout_dirty:
+        node.layout_dirty = True
+        node = node.parent
+
+def clear_layout_dirty(node):
+    # For subtrees that layout never visits, so that a stale flag cannot
+    # stop mark_layout_dirty short of the root later on.
+    if not node.layout_dirty: return
+    node.layout_dirty = False
     for child in node.children:
-            style(child, rules)
+        clear_layout_dirty(child)
 
 def cascade_priority(rule):
     selector, body = rule
@@ -427,48 +991,80 @@ class ClassSelector:
     def __init__(self, classname):
         self.classname = classname
         self.priority = 10
+        self.bloom = bloom_bit("." + classname)
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
         return isinstance(node, Element) and self.classname in node.attributes.get("class", "").split()
 
+    def bucket(self):
+        return "class", self.classname
+
 class IdSelector:
     def __init__(self, id):
         self.id = id
         self.priority = 100
+        self.bloom = bloom_bit("#" + id)
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
         return isinstance(node, Element) and self.id == node.attributes.get("id", "")
 
+    def bucket(self):
+        return "id", self.id
+
 class CompoundSelector:
     def __init__(self, simple_selectors):
         self.simple_selectors = simple_selectors
         self.priority = sum(s.priority for s in simple_selectors)
+        self.bloom = 0
+        for sel in simple_selectors:
+            self.bloom |= sel.bloom
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
         for sel in self.simple_selectors:
             if not sel.matches(node): return False
         return True
+
+    def bucket(self):
+        buckets = [sel.bucket() for sel in self.simple_selectors]
+        for kind in ["id", "class", "tag"]:
+            for bucket in buckets:
+                if bucket[0] == kind: return bucket
+        return "universal", None
     
 class TagSelector:
     def __init__(self, tag):
         self.tag = tag
         self.priority = 1
+        self.bloom = 0 if tag == "*" else bloom_bit(tag)
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
         return isinstance(node, Element) and (self.tag == node.tag or self.tag == "*")
+
+    def bucket(self):
+        if self.tag == "*":
+            return "universal", None
+        return "tag", self.tag
     
 class DescendantSelector:
     def __init__(self, ancestor, descendant):
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        self.bloom = ancestor.bloom | descendant.bloom
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
         if not self.descendant.matches(node): return False
+        # ancestors is a bloom filter of the ancestor chain; if any part
+        # of the ancestor selector is missing from it there is no match
+        if ancestors is not None and self.ancestor.bloom & ~ancestors:
+            return False
         while node.parent:
             if self.ancestor.matches(node.parent): return True
             node = node.parent
         return False
+
+    def bucket(self):
+        return self.descendant.bucket()
     
 class HTMLParser:
     SELF_CLOSING_TAGS = [
@@ -481,27 +1077,39 @@ class HTMLParser:
         "link", "meta", "title", "style", "script",
     ]
 
-    def __init__(self, body):
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        self.pending = []
+        self.in_tag = False
+        self.index = NodeIndex()
 
     def parse(self):
-        text = ""
-        in_tag = False
-        for c in self.body:
-            if c == "<":
-                in_tag = True
+        self.feed(self.body)
+        return self.finish()
+
+    def feed(self, chunk):
+        # Tokens are sliced out between "<" and ">" delimiters; whatever
+        # follows the last delimiter waits in self.pending for more input.
+        end = max(chunk.rfind("<"), chunk.rfind(">")) + 1
+        if end == 0:
+            if chunk: self.pending.append(chunk)
+            return
+        tokens = TAG_TOKENS.findall(chunk, 0, end)
+        if self.pending:
+            text, delimiter = tokens[0]
+            self.pending.append(text)
+            tokens[0] = ("".join(self.pending), delimiter)
+            self.pending = []
+        for text, delimiter in tokens:
+            if delimiter == "<":
+                self.in_tag = True
                 if text: self.add_text(text)
-                text = ""
-            elif c == ">":
-                in_tag = False
-                self.add_tag(text)
-                text = ""
             else:
-                text += c
-        if not in_tag and text:
-            self.add_text(text)
-        return self.finish()
+                self.in_tag = False
+                self.add_tag(text)
+        if end < len(chunk):
+            self.pending.append(chunk[end:])
     
     def add_text(self, text):
         if text.isspace():
@@ -533,10 +1141,12 @@ class HTMLParser:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
             parent.children.append(node)
+            self.index.add(node)
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
             self.unfinished.append(node)
+            self.index.add(node)
 
     def get_attributes(self, text):
         parts = text.split()
@@ -553,6 +1163,8 @@ class HTMLParser:
         return tag, attributes
 
     def implicit_tags(self, tag):
+        # Only the first two levels of the tree are ever implied
+        if len(self.unfinished) > 2: return
         while True:
             open_tags = [node.tag for node in self.unfinished]
             if open_tags == [] and tag != "html":
@@ -568,6 +1180,11 @@ class HTMLParser:
                 break
 
     def finish(self):
+        text = "".join(self.pending)
+        self.pending = []
+        if not self.in_tag and text:
+            self.add_text(text)
+
         if not self.unfinished:
             self.implicit_tags(None)
 
@@ -575,29 +1192,45 @@ class HTMLParser:
             node = self.unfinished.pop()
             parent = self.unfinished[-1]
             parent.children.append(node)
-        return self.unfinished.pop()
+        self.index.root = self.unfinished.pop()
+        return self.index.root
     
 def print_tree(node, indent=0):
     for child in node.children:
         print_tree(child, indent + 2)
 
 class Text:
+    __slots__ = ("text", "children", "parent", "is_focused", "style",
+        "style_dirty", "children_dirty", "layout_dirty")
     def __init__(self, text, parent):
         self.text = text
         self.children = []
         self.parent = parent
         self.is_focused = False
+        self.style = None
+        self.style_dirty = True
+        self.children_dirty = True
+        self.layout_dirty = True
 
     def __repr__(self):
         return repr(self.text)
 
 class Element:
+    # Editing state is only set once an input is focused, so callers
+    # read cursor and selection with getattr defaults
+    __slots__ = ("tag", "attributes", "children", "parent", "is_focused",
+        "style", "style_dirty", "children_dirty", "layout_dirty", "cursor",
+        "selection_start", "selection_end")
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.attributes = attributes
         self.children = []
         self.parent = parent
         self.is_focused = False
+        self.style = None
+        self.style_dirty = True
+        self.children_dirty = True
+        self.layout_dirty = True
 
     def __repr__(self):
         return "<" + self.tag + ">"
\ No newline at end of file
@@ -1,38 +1,110 @@
 LISTENERS = {}
 
+// Requests in flight, by handle, until the browser reports back
+XHR_REQUESTS = {};
+XHR_NEXT_HANDLE = 0;
+
 function XMLHttpRequest() {}
 
 XMLHttpRequest.prototype.open = function(method, url, is_async) {
-    if (is_async) throw Error("Only synchronous XHR is supported");
     this.method = method;
     this.url = url;
+    this.is_async = is_async !== false;
 }
 
 XMLHttpRequest.prototype.send = function(body) {
-    this.responseText = call_python("XMLHttpRequest_send", this.method, this.url, body);
+    var handle = XHR_NEXT_HANDLE++;
+    if (this.is_async) XHR_REQUESTS[handle] = this;
+    var response = call_python("XMLHttpRequest_send",
+        this.method, this.url, body, this.is_async, handle);
+    if (!this.is_async) this.responseText = response;
 }
 
-try {
-    x = new XMLHttpRequest();
-    x.open("GET", "http://localhost:8000/", false);
-    x.send();
-    user = x.responseText.split(" ")[2].split("<")[0];
-} catch (e) {
-    console.log("Could not load user: " + e);
-    user = "guest";
+function runXHRCallback(handle, response, error) {
+    var request = XHR_REQUESTS[handle];
+    if (!request) return;
+    delete XHR_REQUESTS[handle];
+    if (error !== null) {
+        if (request.onerror) request.onerror.call(request, new Event("error"), error);
+        return;
+    }
+    request.responseText = response;
+    if (request.onload) request.onload.call(request, new Event("load"));
 }
-// use x.responseText
+
+user = "guest";
+x = new XMLHttpRequest();
+x.open("GET", "http://localhost:8000/");
+x.onload = function() {
+    try {
+        user = this.responseText.split(" ")[2].split("<")[0];
+    } catch (e) {
+        console.log("Could not load user: " + e);
+    }
+}
+x.onerror = function(e, message) {
+    console.log("Could not load user: " + message);
+}
+x.send();
 
 console.log("Hi from JS!")
+// DOM calls are queued and sent to Python in batches. Writes wait until
+// the next read or the end of the script; reads send everything queued.
+PENDING_DOM = [];
+
+function dom(op) {
+    var ops = PENDING_DOM;
+    PENDING_DOM = [];
+    ops.push(Array.prototype.slice.call(arguments));
+    var results = call_python("dom_batch", ops);
+    return results[results.length - 1];
+}
+
+function queueDOM(op) {
+    PENDING_DOM.push(Array.prototype.slice.call(arguments));
+}
+
+function flushDOM() {
+    if (!PENDING_DOM.length) return;
+    var ops = PENDING_DOM;
+    PENDING_DOM = [];
+    call_python("dom_batch", ops);
+}
+
+// Attributes of every node scripts have seen, by handle. The browser
+// invalidates handles whose attributes it changes.
+ATTRIBUTES = {};
+
+function loadAttributes(handles) {
+    var missing = handles.filter(function(h) { return !(h in ATTRIBUTES); });
+    if (!missing.length) return;
+    var attributes = dom("getAttributes", missing);
+    for (var i = 0; i < missing.length; i++) {
+        ATTRIBUTES[missing[i]] = attributes[i];
+    }
+}
+
+function invalidateAttributes(handles) {
+    for (var i = 0; i < handles.length; i++) {
+        delete ATTRIBUTES[handles[i]];
+    }
+}
+
 document = { querySelectorAll: function(s) {
-    var handle = call_python("querySelectorAll", s);
-    return handle.map(function(h) { return new Node(h)})
+    var handles = dom("querySelectorAll", s);
+    loadAttributes(handles);
+    return handles.map(function(h) { return new Node(h)})
 }}
 
 function Node(handle) {this.handle = handle;}
 
 Node.prototype.getAttribute = function(attr) {
-    return call_python("getAttribute", this.handle, attr);
+    var attributes = ATTRIBUTES[this.handle];
+    if (!attributes) {
+        loadAttributes([this.handle]);
+        attributes = ATTRIBUTES[this.handle];
+    }
+    return attributes.hasOwnProperty(attr) ? attributes[attr] : null;
 }
 
 inputs = document.querySelectorAll('input')
@@ -87,10 +159,27 @@ for (var i = 0; i < inputs.length; i++) {
 
 Object.defineProperty(Node.prototype, 'innerHTML', {
     set: function(s) {
-        call_python("innerHTML_set", this.handle, s.toString());
+        queueDOM("innerHTML_set", this.handle, s.toString());
     }
 });
 
+// Callbacks wait here for the browser's next animation frame; the
+// browser only needs telling once per frame.
+ANIMATION_FRAME_CALLBACKS = [];
+
+function requestAnimationFrame(callback) {
+    if (!ANIMATION_FRAME_CALLBACKS.length) call_python("requestAnimationFrame");
+    ANIMATION_FRAME_CALLBACKS.push(callback);
+}
+
+function runAnimationFrameCallbacks(time) {
+    var callbacks = ANIMATION_FRAME_CALLBACKS;
+    ANIMATION_FRAME_CALLBACKS = [];
+    for (var i = 0; i < callbacks.length; i++) {
+        callbacks[i](time);
+    }
+}
+
 function Event(type) {
     this.type = type
     this.do_default = true;
@@ -2,10 +2,17 @@ import ctypes
 import skia
 import sdl2
 import dukpy
-from browser import URL, HTMLParser, CSSParser, style, cascade_priority
+from browser import URL, HTMLParser, CSSParser, RuleIndex, style, cascade_priority, mark_dirty
+from browser import clear_layout_dirty
 from browser import Text, Element
 import urllib.parse
 import math
+import bisect
+import concurrent.futures
+import threading
+import time
+import traceback
+from collections import OrderedDict, Counter, deque
 
 WIDTH = 800
 HEIGHT = 600 
@@ -16,7 +23,36 @@ SCROLL_STEP = 35
 INPUT_WIDTH_PX = 200
 DEFAULT_STYLE_SHEET = CSSParser(open("browser.css").read()).parse()
 RUNTIME_JS = open("runtime.js").read()
-EVENT_DISPATCH_JS = "new Node(dukpy.handle).dispatchEvent(dukpy.type)"
+EVENT_DISPATCH_JS = "var do_default; try { do_default = new Node(dukpy.handle)" + \
+    ".dispatchEvent(dukpy.type) } finally { flushDOM() } do_default"
+FLUSH_DOM_JS = "flushDOM()"
+ANIMATION_FRAME_JS = "try { runAnimationFrameCallbacks(dukpy.time) } finally { flushDOM() }"
+XHR_ONLOAD_JS = "try { runXHRCallback(dukpy.handle, dukpy.response, dukpy.error) } " + \
+    "finally { flushDOM() }"
+FETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+BFCACHE_MAX_PAGES = 5
+BFCACHE_MAX_NODES = 200000
+MEASURE_CACHE_SIZE = 50000
+SELECTOR_CACHE_SIZE = 1000
+COLOR_CACHE_SIZE = 1000
+TILE_SIZE = 512
+TILE_PADDING = 2
+MAX_TILES = 48
+DAMAGE_PADDING = 2
+LAYER_PADDING = 4
+MAX_LAYER_PIXELS = 4 * TILE_SIZE * TILE_SIZE
+LAYER_CACHE_PIXELS = 32 * TILE_SIZE * TILE_SIZE
+MAX_DAMAGE_RECTS = 16
+# Window surface formats whose bytes skia can draw into directly
+WINDOW_COLOR_TYPES = {
+    sdl2.SDL_PIXELFORMAT_RGBA32: skia.kRGBA_8888_ColorType,
+    sdl2.SDL_PIXELFORMAT_RGBX32: skia.kRGBA_8888_ColorType,
+    sdl2.SDL_PIXELFORMAT_BGRA32: skia.kBGRA_8888_ColorType,
+    sdl2.SDL_PIXELFORMAT_BGRX32: skia.kBGRA_8888_ColorType,
+}
+TALL_COMMAND = 512
+REFRESH_RATE_SEC = 1 / 60
+IDLE_TIMEOUT_MS = 250
 
 NAMED_COLORS = {
     "black": "#000000",
@@ -72,40 +108,126 @@ def parse_font_weight(weight_str):
         return "bold"
     return "normal"
 
+SELECTORS = OrderedDict()
+
+def parse_selector(selector_text):
+    selector = SELECTORS.get(selector_text)
+    if selector is None:
+        selector = SELECTORS[selector_text] = CSSParser(selector_text).selector()
+        if len(SELECTORS) > SELECTOR_CACHE_SIZE:
+            SELECTORS.popitem(last=False)
+    else:
+        SELECTORS.move_to_end(selector_text)
+    return selector
+
 class JSContext:
-    def __init__(self, tab):
+    def __init__(self, tab, index):
         self.tab = tab
+        self.index = index
         self.interp = dukpy.JSInterpreter()
         self.node_to_handle = {}
         self.handle_to_node = {}
+        # Handles whose attributes changed outside of JS since scripts last
+        # ran, so the runtime's attribute cache can drop them
+        self.stale_handles = set()
+        # XHR results that came back while the page sat in the back-forward
+        # cache, delivered if it is restored
+        self.parked_xhr = []
+        self.discarded = False
+        # DOM calls that runtime.js queues up and sends over in one crossing
+        self.dom_ops = {
+            "querySelectorAll": self.querySelectorAll,
+            "getAttributes": self.getAttributes,
+            "innerHTML_set": self.innerHTML_set,
+        }
         self.interp.export_function("log", print)
-        self.interp.export_function("querySelectorAll", self.querySelectorAll)
-        self.interp.export_function("getAttribute", self.getAttribute)
-        self.interp.export_function("innerHTML_set", self.innerHTML_set)
+        self.interp.export_function("dom_batch", self.dom_batch)
+        self.interp.export_function("requestAnimationFrame",
+            self.requestAnimationFrame)
         self.interp.export_function("XMLHttpRequest_send", self.XMLHttpRequest_send)
         self.interp.evaljs(RUNTIME_JS)
 
     def run(self,script, code):
+        self.sync_attributes()
         try:
             return self.interp.evaljs(code)
         except dukpy.JSRuntimeError as e:
             print("Script", script, "crashed", e)
+        finally:
+            try:
+                self.interp.evaljs(FLUSH_DOM_JS)
+            except dukpy.JSRuntimeError as e:
+                print("Script", script, "crashed", e)
+
+    def requestAnimationFrame(self):
+        self.tab.request_animation_frame_callback()
 
-    def XMLHttpRequest_send(self, method, url, body):
-        full_url = self.tab.url.resolve(url)
-        if not self.tab.js.allowed_request(full_url):
+    def run_animation_frame_callbacks(self, timestamp):
+        self.sync_attributes()
+        try:
+            self.interp.evaljs(ANIMATION_FRAME_JS, time=timestamp)
+        except dukpy.JSRuntimeError as e:
+            print("Animation frame callback crashed", e)
+
+    def dom_batch(self, ops):
+        return [self.dom_ops[op](*args) for op, *args in ops]
+
+    def XMLHttpRequest_send(self, method, url, body, is_async, handle):
+        page_url = self.tab.url
+        full_url = page_url.resolve(url)
+        allowed = self.tab.allowed_request(full_url)
+        if not is_async:
+            return self.xhr_request(page_url, full_url, body, allowed)
+        # Asynchronous requests run on the fetch pool; the result comes
+        # back as a task on the tab's thread, where the page's JS lives
+        def run_load():
+            try:
+                out = self.xhr_request(page_url, full_url, body, allowed)
+                error = None
+            except Exception as e:
+                out, error = None, str(e)
+            self.tab.task_runner.schedule_task(
+                Task(self.dispatch_xhr_onload, handle, out, error))
+        FETCH_POOL.submit(run_load)
+
+    def xhr_request(self, page_url, full_url, body, allowed):
+        if not allowed:
             raise Exception("Cross-origin XHR blocked by CSP")
-        headers, out = full_url.request(self.tab.url, body)
-        if full_url.origin() != self.tab.url.origin():
+        headers, out = full_url.request(page_url, body)
+        if full_url.origin() != page_url.origin():
             raise Exception("Cross-origin XHR request not allowed")
         return out
 
+    def dispatch_xhr_onload(self, handle, out, error):
+        if self.discarded:
+            return
+        if self.tab.js is not self:
+            self.parked_xhr.append((handle, out, error))
+            return
+        self.sync_attributes()
+        try:
+            self.interp.evaljs(XHR_ONLOAD_JS,
+                handle=handle, response=out, error=error)
+        except dukpy.JSRuntimeError as e:
+            print("XHR callback crashed", e)
+
+    def resume(self):
+        parked, self.parked_xhr = self.parked_xhr, []
+        for args in parked:
+            self.tab.task_runner.schedule_task(
+                Task(self.dispatch_xhr_onload, *args))
+
+    def discard(self):
+        self.discarded = True
+        self.parked_xhr = []
+
     def querySelectorAll(self, selector_text):
-        selector = CSSParser(selector_text).selector()
-        nodes = [node for node
-                in tree_to_list(self.tab.nodes, [])
-                if selector.matches(node)]
-        return [self.get_handle(node) for node in nodes]
+        selector = parse_selector(selector_text)
+        candidates = self.index.candidates(selector)
+        if candidates is None:
+            candidates = tree_to_list(self.tab.nodes, [])
+        return [self.get_handle(node) for node in candidates
+            if selector.matches(node)]
     
     def get_handle(self, elt):
         if elt not in self.node_to_handle:
@@ -116,25 +238,44 @@ class JSContext:
             handle = self.node_to_handle[elt]
         return handle
     
-    def getAttribute(self, handle, attr):
-        elt = self.handle_to_node[handle]
-        attr_value = elt.attributes.get(attr, None)
-        return attr_value if attr_value is not None else None
+    def getAttributes(self, handles):
+        return [self.handle_to_node[handle].attributes for handle in handles]
+
+    def attribute_changed(self, elt):
+        handle = self.node_to_handle.get(elt)
+        if handle is not None:
+            self.stale_handles.add(handle)
+
+    def sync_attributes(self):
+        if self.stale_handles:
+            self.interp.evaljs("invalidateAttributes(dukpy.handles)",
+                handles=list(self.stale_handles))
+            self.stale_handles.clear()
     
     def dispatch_event(self, type, elt):
         handle = self.node_to_handle.get(elt, -1)
-
-        do_default = self.interp.evaljs(EVENT_DISPATCH_JS, type=type, handle=handle)
-        return do_default
+        self.sync_attributes()
+        try:
+            return self.interp.evaljs(EVENT_DISPATCH_JS, type=type, handle=handle)
+        except dukpy.JSRuntimeError as e:
+            print("Event listener crashed", e)
 
     def innerHTML_set(self, handle, s):
         doc = HTMLParser("<html><body>" + s + "</body></html>").parse()
         new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
+        # Subtrees already detached from the document stay out of the index
+        in_document = self.index.contains(elt)
+        if in_document:
+            for child in elt.children:
+                self.index.remove_tree(child)
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
-        self.tab.render()
+            if in_document:
+                self.index.add_tree(child)
+        mark_dirty(elt)
+        self.tab.set_needs_render()
 
 class Chrome:
     def __init__(self, browser):
@@ -145,7 +286,7 @@ class Chrome:
         self.padding = 5
         self.tabbar_top = 0
         self.tabbar_bottom = self.font_height + 2*self.padding
-        plus_width = self.font.measureText("+") + 2*self.padding
+        plus_width = measure_text(self.font, "+") + 2*self.padding
         self.newtab_rect = skia.Rect.MakeLTRB(
             self.padding, 
             self.padding,
@@ -156,21 +297,21 @@ class Chrome:
         self.urlbar_top = self.tabbar_bottom
         self.urlbar_bottom = self.urlbar_top + self.font_height + 2*self.padding
         self.bottom = self.urlbar_bottom
-        back_width = self.font.measureText("<") + 2*self.padding
+        back_width = measure_text(self.font, "<") + 2*self.padding
         self.back_rect = skia.Rect.MakeLTRB(
             self.padding,
             self.urlbar_top + self.padding,
             self.padding + back_width,
             self.urlbar_bottom - self.padding)
 
-        forward_width = self.font.measureText(">") + 2*self.padding
+        forward_width = measure_text(self.font, ">") + 2*self.padding
         self.forward_rect = skia.Rect.MakeLTRB(
             self.back_rect.right() + self.padding,
             self.urlbar_top + self.padding,
             self.back_rect.right() + self.padding + forward_width,
             self.urlbar_bottom - self.padding)
 
-        reload_width = self.font.measureText("R") + 2*self.padding
+        reload_width = measure_text(self.font, "R") + 2*self.padding
         self.reload_rect = skia.Rect.MakeLTRB(
             self.forward_rect.right() + self.padding,
             self.urlbar_top + self.padding,
@@ -286,16 +427,16 @@ class Chrome:
             if self.is_url(text):
                 if not ("://" in text or text.startswith("data:")):
                     text = "https://" + text
-                self.browser.active_tab.load(URL(text))
+                self.browser.run_in_tab(self.browser.active_tab.load, URL(text))
             else:
                 query = urllib.parse.quote_plus(text)
                 search_url = "https://www.google.com/search?q=" + query
-                self.browser.active_tab.load(URL(search_url))
+                self.browser.run_in_tab(self.browser.active_tab.load, URL(search_url))
             self.focus = None
 
     def tab_rect(self, i):
         tabs_start = self.newtab_rect.right() + self.padding
-        tab_width = self.font.measureText("Tab X") + 2*self.padding
+        tab_width = measure_text(self.font, "Tab X") + 2*self.padding
         return skia.Rect.MakeLTRB(
             tabs_start + tab_width * i,
             self.tabbar_top,
@@ -309,19 +450,19 @@ class Chrome:
         if self.newtab_rect.contains(x, y):
             self.browser.new_tab(URL("about:blank"))
         elif self.back_rect.contains(x, y):
-            self.browser.active_tab.go_back()
+            self.browser.run_in_tab(self.browser.active_tab.go_back)
         elif self.forward_rect.contains(x, y):
-            self.browser.active_tab.go_forward()
+            self.browser.run_in_tab(self.browser.active_tab.go_forward)
         elif self.reload_rect.contains(x, y):
-            self.browser.active_tab.reload()
+            self.browser.run_in_tab(self.browser.active_tab.reload)
         elif self.address_rect.contains(x, y):
             self.focus = "address bar"
             if not was_focused:
-                self.address_bar = str(self.browser.active_tab.url)
+                self.address_bar = str(self.browser.active_tab_url or "")
             
             self.cursor = len(self.address_bar)
             for i in range(len(self.address_bar)):
-                w = self.font.measureText(self.address_bar[:i+1])
+                w = measure_text(self.font, self.address_bar[:i+1])
                 if self.address_rect.left() + self.padding + w > x:
                     self.cursor = i
                     break
@@ -330,7 +471,7 @@ class Chrome:
         else:
             for i, tab in enumerate(self.browser.tabs):
                 if self.tab_rect(i).contains(x, y):
-                    self.browser.active_tab = tab
+                    self.browser.set_active_tab(tab)
                     break
     
     def paint(self):
@@ -372,7 +513,8 @@ class Chrome:
                     bounds.right(), bounds.bottom(), self.width, bounds.bottom(), "black", 1))
 
         # Draw back button (gray if can't go back)
-        back_color = "black" if len(self.browser.active_tab.history) > 1 else "gray"
+        can_go_back, can_go_forward = self.browser.active_tab_history
+        back_color = "black" if can_go_back else "gray"
         cmds.append(DrawOutline(self.back_rect, back_color, 1))
         cmds.append(DrawText(
             self.back_rect.left() + self.padding,
@@ -380,7 +522,7 @@ class Chrome:
             "<", self.font, back_color))
         
         # Draw forward button (gray if can't go forward)
-        forward_color = "black" if len(self.browser.active_tab.forward_history) > 0 else "gray"
+        forward_color = "black" if can_go_forward else "gray"
         cmds.append(DrawOutline(self.forward_rect, forward_color, 1))
         cmds.append(DrawText(
             self.forward_rect.left() + self.padding,
@@ -400,8 +542,8 @@ class Chrome:
             if self.selection_start is not None:
                 start = min(self.selection_start, self.selection_end)
                 end = max(self.selection_start, self.selection_end)
-                start_x = self.address_rect.left() + self.padding + self.font.measureText(self.address_bar[:start])
-                end_x = self.address_rect.left() + self.padding + self.font.measureText(self.address_bar[:end])
+                start_x = self.address_rect.left() + self.padding + measure_text(self.font, self.address_bar[:start])
+                end_x = self.address_rect.left() + self.padding + measure_text(self.font, self.address_bar[:end])
                 cmds.append(DrawRRect(skia.Rect.MakeLTRB(start_x, self.address_rect.top() + self.padding, end_x, self.address_rect.bottom() - self.padding), 0, "lightblue"))
 
             cmds.append(DrawText(
@@ -410,7 +552,7 @@ class Chrome:
                 self.address_bar,
                 self.font,
                 "black"))
-            w = self.font.measureText(self.address_bar[:self.cursor])
+            w = measure_text(self.font, self.address_bar[:self.cursor])
             cmds.append(DrawLine(
                 self.address_rect.left() + self.padding + w,
                 self.address_rect.top(),
@@ -418,7 +560,7 @@ class Chrome:
                 self.address_rect.bottom(),
                 "red", 1))
         else:
-            url = str(self.browser.active_tab.url)
+            url = str(self.browser.active_tab_url or "")
             cmds.append(DrawText(
                 self.address_rect.left() + self.padding,
                 self.address_rect.top(),
@@ -429,44 +571,41 @@ class Chrome:
         return cmds
     
 class DrawLine:
+    __slots__ = ("rect", "color", "thickness", "paint")
     def __init__(self, x1, y1, x2, y2, color, thickness):
         self.rect = skia.Rect.MakeLTRB(x1, y1, x2, y2)
         self.color = color
         self.thickness = thickness
+        self.paint = get_paint(color, thickness)
 
     @property
     def bottom(self):
         return self.rect.bottom()
 
-    def execute(self, scroll, canvas):
-        path = skia.Path().moveTo(
-            self.rect.left(), self.rect.top() - scroll) \
-                .lineTo(self.rect.right(),
-                    self.rect.bottom() - scroll)
-        paint = skia.Paint(
-            Color=parse_color(self.color),
-            StrokeWidth=self.thickness,
-            Style=skia.Paint.kStroke_Style,
-        )
-        canvas.drawPath(path, paint)
+    def signature(self):
+        return rect_key(self.rect) + ("line", self.color, self.thickness)
+
+    def execute(self, canvas):
+        canvas.drawLine(self.rect.left(), self.rect.top(),
+            self.rect.right(), self.rect.bottom(), self.paint)
     
 class DrawOutline:
+    __slots__ = ("rect", "color", "thickness", "paint")
     def __init__(self, rect, color, thickness):
         self.rect = rect
         self.color = color
         self.thickness = thickness
+        self.paint = get_paint(color, thickness)
 
     @property
     def bottom(self):
         return self.rect.bottom()
 
-    def execute(self, scroll, canvas):
-        paint = skia.Paint(
-            Color=parse_color(self.color),
-            StrokeWidth=self.thickness,
-            Style=skia.Paint.kStroke_Style,
-        )
-        canvas.drawRect(self.rect.makeOffset(0, -scroll), paint)
+    def signature(self):
+        return rect_key(self.rect) + ("outline", self.color, self.thickness)
+
+    def execute(self, canvas):
+        canvas.drawRect(self.rect, self.paint)
 
 class Browser:
     def __init__(self):
@@ -476,12 +615,6 @@ class Browser:
             sdl2.SDL_WINDOWPOS_CENTERED, sdl2.SDL_WINDOWPOS_CENTERED,
             WIDTH, HEIGHT, sdl2.SDL_WINDOW_SHOWN | sdl2.SDL_WINDOW_RESIZABLE)
         
-        self.root_surface = skia.Surface.MakeRaster(
-            skia.ImageInfo.Make(
-                WIDTH, HEIGHT,
-                ct=skia.kRGBA_8888_ColorType,
-                at=skia.kUnpremul_AlphaType))
-        
         if sdl2.SDL_BYTEORDER == sdl2.SDL_BIG_ENDIAN:
             self.RED_MASK = 0xff000000
             self.GREEN_MASK = 0x00ff0000
@@ -495,195 +628,741 @@ class Browser:
         
         self.width = WIDTH
         self.height = HEIGHT
-        self.scroll = 0
+        self.sdl_surface = None
+        self.make_root_surface(WIDTH, HEIGHT)
+        self.title = None
+        self.chrome_cmds = []
+        self.last_frame = None
+        self.last_scrollbar = None
         self.url = None
+        self.focus = None
         self.chrome = Chrome(self)
         self.chrome_surface = skia.Surface(WIDTH, math.ceil(self.chrome.bottom))
-        self.tab_surface = None
+        self.tab_height = HEIGHT - self.chrome.bottom
+
+        # Tabs run on their own threads and hand over what the browser
+        # needs to draw them through commit(), under this lock
+        self.lock = threading.RLock()
+        self.tiles = TileCache()
+        self.needs_draw = False
+        self.scrolling = False
+        self.clipboard = None
+        self.animation_timer = None
+        self.last_animation_frame = 0
+
+    def make_root_surface(self, width, height):
+        # Skia draws straight into the window surface's pixels when their
+        # format allows it, so presenting a frame needs no copy. Otherwise
+        # it draws into one persistent buffer that SDL blits from.
+        self.full_damage = True
+        window_surface = sdl2.SDL_GetWindowSurface(self.sdl_window).contents
+        color_type = WINDOW_COLOR_TYPES.get(window_surface.format.contents.format)
+        if self.sdl_surface:
+            sdl2.SDL_FreeSurface(self.sdl_surface)
+            self.sdl_surface = None
+        if color_type is not None:
+            self.pixels = (ctypes.c_ubyte * (window_surface.pitch * window_surface.h)) \
+                .from_address(window_surface.pixels)
+            self.root_surface = skia.Surface.MakeRasterDirect(
+                skia.ImageInfo.Make(
+                    window_surface.w, window_surface.h,
+                    ct=color_type,
+                    at=skia.kPremul_AlphaType),
+                self.pixels, window_surface.pitch)
+            return
+        pitch = 4 * width # Bytes per row
+        self.pixels = (ctypes.c_ubyte * (pitch * height))()
+        self.root_surface = skia.Surface.MakeRasterDirect(
+            skia.ImageInfo.Make(
+                width, height,
+                ct=skia.kRGBA_8888_ColorType,
+                at=skia.kUnpremul_AlphaType),
+            self.pixels, pitch)
+        depth = 32 # Bits per pixel
+        self.sdl_surface = sdl2.SDL_CreateRGBSurfaceFrom(
+            self.pixels, width, height, depth, pitch,
+            self.RED_MASK, self.GREEN_MASK,
+            self.BLUE_MASK, self.ALPHA_MASK)
+
+    def commit(self, tab, data):
+        with self.lock:
+            if tab != self.active_tab:
+                return
+            self.active_tab_url = data.url
+            self.active_tab_title = data.title
+            self.active_tab_history = data.history
+            self.active_tab_height = data.height
+            self.active_tab_display_list = data.display_list
+            # The tab's own scroll wins only when it moved the page itself,
+            # e.g. on navigation; otherwise the scroll here is newer
+            if data.scroll_serial != self.active_tab_scroll_serial:
+                self.active_tab_scroll = data.scroll
+                self.active_tab_scroll_serial = data.scroll_serial
+            if data.damage is None:
+                self.tiles.clear()
+                self.active_tab_damage = None
+            else:
+                for rect in data.damage:
+                    self.tiles.invalidate(rect)
+                if self.active_tab_damage is not None:
+                    self.active_tab_damage.extend(data.damage)
+            if data.clipboard is not None:
+                self.clipboard = data.clipboard
+            self.needs_draw = True
+        # Wake the main loop, which may be waiting for input
+        wake = sdl2.SDL_Event()
+        wake.type = sdl2.SDL_USEREVENT
+        sdl2.SDL_PushEvent(ctypes.byref(wake))
+
+    def set_needs_animation_frame(self, tab):
+        # Frames are paced to the refresh rate; everything a tab does in
+        # between is rendered and committed together in the next one
+        with self.lock:
+            if tab is not self.active_tab or self.animation_timer:
+                return
+            delay = self.last_animation_frame + REFRESH_RATE_SEC - time.perf_counter()
+            self.animation_timer = threading.Timer(max(delay, 0), self.animation_frame)
+            self.animation_timer.daemon = True
+            self.animation_timer.start()
+
+    def animation_frame(self):
+        with self.lock:
+            self.animation_timer = None
+            self.last_animation_frame = time.perf_counter()
+            tab = self.active_tab
+            tab.task_runner.schedule_animation_frame(
+                Task(tab.run_animation_frame, self.last_animation_frame * 1000))
+
+    def set_active_tab(self, tab):
+        with self.lock:
+            self.active_tab = tab
+            self.active_tab_url = None
+            self.active_tab_title = None
+            self.active_tab_history = (False, False)
+            self.active_tab_height = 0
+            self.active_tab_display_list = DisplayList()
+            self.active_tab_scroll = 0
+            self.active_tab_scroll_serial = None
+            self.active_tab_damage = None
+            self.scrolling = False
+            self.tiles.clear()
+            self.needs_draw = True
+            self.run_in_tab(tab.invalidate)
+
+    def run_in_tab(self, task_code, *args):
+        self.active_tab.task_runner.schedule_task(Task(task_code, *args))
+
+    def raster_and_draw(self):
+        with self.lock:
+            if not self.needs_draw:
+                return
+            self.needs_draw = False
+            # SDL is only used from this thread
+            if self.clipboard is not None:
+                sdl2.SDL_SetClipboardText(self.clipboard.encode())
+                self.clipboard = None
+            self.raster_tab()
+            self.draw()
 
     def raster_tab(self):
-        tab_height = math.ceil(self.active_tab.document.height + 2*VSTEP)
-        if not self.tab_surface or tab_height != self.tab_surface.height():
-            self.tab_surface = skia.Surface(WIDTH, tab_height)
-        canvas = self.tab_surface.getCanvas()
-        canvas.clear(skia.ColorWHITE)
+        # Make sure every tile under the viewport is rasterized
+        for col, row in self.visible_tiles():
+            self.tiles.get(col, row, self.active_tab_display_list)
+
+    def visible_tiles(self):
+        first_row = max(int(self.active_tab_scroll // TILE_SIZE), 0)
+        last_row = int((self.active_tab_scroll + self.tab_height) // TILE_SIZE)
+        last_col = int(self.width // TILE_SIZE)
+        for row in range(first_row, last_row + 1):
+            for col in range(last_col + 1):
+                yield col, row
 
     def raster_chrome(self):
         canvas = self.chrome_surface.getCanvas()
         canvas.clear(skia.ColorWHITE)
 
     def handle_quit(self):
+        for tab in self.tabs:
+            tab.task_runner.set_needs_quit()
+        if self.sdl_surface:
+            sdl2.SDL_FreeSurface(self.sdl_surface)
         sdl2.SDL_DestroyWindow(self.sdl_window)
 
     def handle_enter(self):
         if self.chrome.focus == "address bar":
             self.chrome.enter()
         elif self.focus == "content":
-            self.active_tab.enter()
-        self.draw()
+            self.run_in_tab(self.active_tab.enter)
+        self.needs_draw = True
 
     def handle_backspace(self):
         if self.chrome.focus == "address bar":
             self.chrome.backspace()
         elif self.focus == "content":
-            self.active_tab.backspace()
-        self.draw()
+            self.run_in_tab(self.active_tab.backspace)
+        self.needs_draw = True
 
     def handle_left(self, mod):
         if self.chrome.focus == "address bar":
             self.chrome.arrow_left(mod)
         elif self.focus == "content":
-            self.active_tab.arrow_left(mod)
-        self.draw()
+            self.run_in_tab(self.active_tab.arrow_left, mod)
+        self.needs_draw = True
 
     def handle_right(self, mod):
         if self.chrome.focus == "address bar":
             self.chrome.arrow_right(mod)
         elif self.focus == "content":
-            self.active_tab.arrow_right(mod)
-        self.draw()
+            self.run_in_tab(self.active_tab.arrow_right, mod)
+        self.needs_draw = True
 
     def handle_copy(self):
         if self.chrome.focus == "address bar":
             self.chrome.copy()
         elif self.focus == "content":
-            self.active_tab.copy()
+            self.run_in_tab(self.active_tab.copy)
 
     def handle_paste(self):
         if self.chrome.focus == "address bar":
             self.chrome.paste()
         elif self.focus == "content":
-            self.active_tab.paste()
-        self.draw()
+            text = sdl2.SDL_GetClipboardText()
+            if text:
+                self.run_in_tab(self.active_tab.paste, text.decode('utf8'))
+        self.needs_draw = True
 
     def handle_cut(self):
         if self.chrome.focus == "address bar":
             self.chrome.cut()
         elif self.focus == "content":
-            self.active_tab.cut()
-        self.draw()
+            self.run_in_tab(self.active_tab.cut)
+        self.needs_draw = True
 
     def handle_key(self, char):
         if len(char) == 0: return
         if not (0x20 <= ord(char) < 0x7f): return
         if self.chrome.key_press(char):
-            self.draw()
+            self.needs_draw = True
         elif self.focus == "content":
-            self.active_tab.key_press(char)
-            self.draw()
+            self.run_in_tab(self.active_tab.key_press, char)
+
+    def set_scroll(self, scroll):
+        # Scrolling is handled here so it keeps up while the tab is busy;
+        # the tab is told afterwards, for clicks and history
+        self.active_tab_scroll = scroll
+        self.run_in_tab(self.active_tab.set_scroll,
+            scroll, self.active_tab_scroll_serial)
+        self.needs_draw = True
+
+    def scrolldown(self):
+        max_y = max(self.active_tab_height + 2*VSTEP - self.tab_height, 0)
+        self.set_scroll(min(self.active_tab_scroll + SCROLL_STEP, max_y))
+
+    def scrollup(self):
+        if not self.active_tab_scroll <= 0:
+            self.set_scroll(self.active_tab_scroll - SCROLL_STEP)
 
     def handle_down(self):
-        self.active_tab.scrolldown()
-        self.draw()
+        with self.lock:
+            self.scrolldown()
 
     def handle_up(self):
-        self.active_tab.scrollup()
-        self.draw()
+        with self.lock:
+            self.scrollup()
 
     def handle_mousewheel(self, e):
-        if self.active_tab:
-            self.active_tab.mousewheel(e)
-        self.draw()
+        with self.lock:
+            if not self.active_tab_display_list:
+                return
+            if e.y > 0:
+                self.scrollup()
+            elif e.y < 0:
+                self.scrolldown()
 
     def handle_mousedown(self, e):
-        if e.y < self.chrome.bottom:
-            pass
-        else:
-            self.focus = "content"
-            self.chrome.blur()
-            tab_y = e.y - self.chrome.bottom
-            self.active_tab.mousedown(e.x, tab_y)
-        self.draw()
+        with self.lock:
+            if e.y < self.chrome.bottom:
+                pass
+            else:
+                self.focus = "content"
+                self.chrome.blur()
+                tab_y = e.y - self.chrome.bottom
+                rect = self.scrollbar_rect()
+                if rect and rect.left() <= e.x <= rect.right() \
+                        and rect.top() <= tab_y <= rect.bottom():
+                    self.scrolling = True
+                    self.scroll_start_y = tab_y
+                    self.scroll_start_scroll = self.active_tab_scroll
+            self.needs_draw = True
 
     def handle_mousemotion(self, e):
-        if self.active_tab and self.active_tab.scrolling:
-            tab_y = e.y - self.chrome.bottom
-            self.active_tab.mousemotion(e.x, tab_y)
-            self.draw()
+        with self.lock:
+            if self.scrolling:
+                tab_y = e.y - self.chrome.bottom
+                content_height = self.active_tab_display_list.bottom + VSTEP
+                dy = tab_y - self.scroll_start_y
+                scroll_dy = dy * (content_height / self.tab_height)
+                max_y = max(content_height - self.tab_height, 0)
+                self.set_scroll(max(0,
+                    min(self.scroll_start_scroll + scroll_dy, max_y)))
 
     def handle_click(self, e):
-        if e.y < self.chrome.bottom:
-            self.focus = None
-            self.chrome.click(e.x, e.y)
-            self.raster_chrome()
-        else:
-            self.focus = "content"
-            self.chrome.blur()
-            url = self.active_tab.url
-            tab_y = e.y - self.chrome.bottom
-            self.active_tab.click(e.x, tab_y)
-            if self.active_tab.url != url:
+        with self.lock:
+            if self.scrolling:
+                self.scrolling = False
+            elif e.y < self.chrome.bottom:
+                self.focus = None
+                self.chrome.click(e.x, e.y)
                 self.raster_chrome()
-            self.raster_tab()
-        self.draw()
+            else:
+                self.focus = "content"
+                self.chrome.blur()
+                tab_y = e.y - self.chrome.bottom
+                self.run_in_tab(self.active_tab.click,
+                    e.x, tab_y + self.active_tab_scroll)
+            self.needs_draw = True
 
     def handle_configure(self, width, height):
-        self.width = width
-        self.height = height
-        self.root_surface = skia.Surface.MakeRaster(
-            skia.ImageInfo.Make(
-                width, height,
-                ct=skia.kRGBA_8888_ColorType,
-                at=skia.kUnpremul_AlphaType))
-        self.chrome.resize(width)
-        if self.active_tab:
-            self.active_tab.resize(width, height - self.chrome.bottom)
-        self.draw()
+        with self.lock:
+            self.width = width
+            self.height = height
+            self.make_root_surface(width, height)
+            self.chrome.resize(width)
+            self.tab_height = height - self.chrome.bottom
+            if self.active_tab:
+                self.run_in_tab(self.active_tab.resize, width, self.tab_height)
+            self.needs_draw = True
 
     def draw(self):
-        canvas = self.root_surface.getCanvas()
-        canvas.clear(skia.ColorWHITE)
+        # Set window title from page's <title> element
+        title = self.active_tab_title or str(self.active_tab_url or "")
+        if title != self.title:
+            sdl2.SDL_SetWindowTitle(self.sdl_window, title.encode())
+            self.title = title
 
-        tab_rect = skia.Rect.MakeLTRB(0, self.chrome.bottom, WIDTH, HEIGHT)
-        tab_offset = self.chrome.bottom - self.active_tab.scroll
-        canvas.save()
-        canvas.clipRect(tab_rect)
-        canvas.translate(0, tab_offset)
-        self.tab_surface.draw(canvas, 0, 0)
-        canvas.restore()
+        chrome_cmds = self.chrome.paint()
+        damage = self.frame_damage(chrome_cmds)
+        if not damage:
+            return
 
+        canvas = self.root_surface.getCanvas()
         chrome_rect = skia.Rect.MakeLTRB(0, 0, WIDTH, self.chrome.bottom)
+        for rect in damage:
+            canvas.save()
+            canvas.clipRect(rect)
+            canvas.clear(skia.ColorWHITE)
+
+            canvas.save()
+            canvas.clipRect(chrome_rect)
+            self.chrome_surface.draw(canvas, 0, 0)
+            canvas.restore()
+        
+            self.draw_tab(canvas, self.chrome.bottom)
+            for cmd in chrome_cmds:
+                cmd.execute(canvas)
+            canvas.restore()
+
+        rects = (sdl2.SDL_Rect * len(damage))()
+        for i, rect in enumerate(damage):
+            left, top = math.floor(rect.left()), math.floor(rect.top())
+            rects[i] = sdl2.SDL_Rect(left, top,
+                math.ceil(rect.right()) - left, math.ceil(rect.bottom()) - top)
+        if self.sdl_surface:
+            window_surface = sdl2.SDL_GetWindowSurface(self.sdl_window)
+            for rect in rects:
+                # SDL_BlitSurface is what actually does the copy.
+                sdl2.SDL_BlitSurface(self.sdl_surface, rect,
+                    window_surface, sdl2.SDL_Rect(rect.x, rect.y))
+        sdl2.SDL_UpdateWindowSurfaceRects(self.sdl_window, rects, len(damage))
+
+    def draw_tab(self, canvas, offset):
         canvas.save()
-        canvas.clipRect(chrome_rect)
-        self.chrome_surface.draw(canvas, 0, 0)
-        canvas.restore()
+        canvas.translate(0, offset)
+        canvas.clipRect(skia.Rect.MakeLTRB(0, 0, self.width, self.tab_height))
+        for col, row in self.visible_tiles():
+            tile = self.tiles.get(col, row, self.active_tab_display_list)
+            tile.draw(canvas,
+                col * TILE_SIZE, row * TILE_SIZE - self.active_tab_scroll)
         
-        self.active_tab.draw(canvas, self.chrome.bottom)
-        for cmd in self.chrome.paint():
-            cmd.execute(0, canvas)
+        self.draw_scrollbar(canvas, 0)
+        canvas.restore()
+
+    def scrollbar_rect(self):
+        if not self.active_tab_display_list:
+            return None
+            
+        content_height = self.active_tab_display_list.bottom + VSTEP
+        if content_height <= self.tab_height:
+            return None
+            
+        scrollbar_width = 12
+        scrollbar_height = (self.tab_height / content_height) * self.tab_height
+        scrollbar_y = (self.active_tab_scroll / content_height) * self.tab_height
         
-        # Set window title from page's <title> element
-        title = self.active_tab.get_title()
-        if title:
-            sdl2.SDL_SetWindowTitle(self.sdl_window, title.encode())
-        else:
-            sdl2.SDL_SetWindowTitle(self.sdl_window, str(self.active_tab.url).encode())
+        return skia.Rect.MakeLTRB(
+            self.width - scrollbar_width, scrollbar_y,
+            self.width, scrollbar_y + scrollbar_height)
 
-        skia_image = self.root_surface.makeImageSnapshot()
-        skia_bytes = skia_image.tobytes()
-        depth = 32 # Bits per pixel
-        pitch = 4 * self.width # Bytes per row
-        sdl_surface = sdl2.SDL_CreateRGBSurfaceFrom(
-            skia_bytes, self.width, self.height, depth, pitch,
-            self.RED_MASK, self.GREEN_MASK,
-            self.BLUE_MASK, self.ALPHA_MASK)
-        rect = sdl2.SDL_Rect(0, 0, self.width, self.height)
-        window_surface = sdl2.SDL_GetWindowSurface(self.sdl_window)
-        # SDL_BlitSurface is what actually does the copy.
-        sdl2.SDL_BlitSurface(sdl_surface, rect, window_surface, rect)
-        sdl2.SDL_UpdateWindowSurface(self.sdl_window)
+    def draw_scrollbar(self, canvas, offset):
+        rect = self.scrollbar_rect()
+        if not rect:
+            return
+        rect.offset(0, offset)
+        canvas.drawRect(rect, get_paint("blue"))
+
+    def frame_damage(self, chrome_cmds):
+        # Window-space rects whose pixels differ from the last presented
+        # frame: changed chrome commands, repainted parts of the page and
+        # the scrollbar, or the whole tab after a scroll, resize or switch
+        page_damage = self.active_tab_damage
+        self.active_tab_damage = []
+        scrollbar = self.scrollbar_rect()
+        frame = (self.active_tab, self.active_tab_scroll,
+            self.width, self.tab_height)
+        window_rect = skia.Rect.MakeLTRB(0, 0, self.width, self.height)
+        if self.full_damage:
+            damage = [window_rect]
+        else:
+            damage = display_list_damage(self.chrome_cmds, chrome_cmds)
+            if page_damage is None or frame != self.last_frame:
+                damage.append(skia.Rect.MakeLTRB(
+                    0, self.chrome.bottom, self.width, self.height))
+            else:
+                for rect in page_damage:
+                    damage.append(rect.makeOffset(
+                        0, self.chrome.bottom - self.active_tab_scroll))
+                scrollbar_key = scrollbar and rect_key(scrollbar)
+                if scrollbar_key != self.last_scrollbar:
+                    for key in (scrollbar_key, self.last_scrollbar):
+                        if key:
+                            damage.append(skia.Rect.MakeLTRB(*key) \
+                                .makeOffset(0, self.chrome.bottom))
+        self.full_damage = False
+        self.chrome_cmds = chrome_cmds
+        self.last_frame = frame
+        self.last_scrollbar = scrollbar and rect_key(scrollbar)
+
+        clipped = []
+        for rect in damage:
+            rect = rect.makeOutset(DAMAGE_PADDING, DAMAGE_PADDING)
+            if rect.intersect(window_rect):
+                clipped.append(rect)
+        if len(clipped) > MAX_DAMAGE_RECTS:
+            union = skia.Rect.MakeEmpty()
+            for rect in clipped:
+                union.join(rect)
+            clipped = [union]
+        return clipped
 
     def new_tab(self, url):
-        new_tab = Tab(HEIGHT - self.chrome.bottom)
-        new_tab.load(url)
-        self.active_tab = new_tab
-        self.tabs.append(new_tab)
-        self.raster_tab()
-        self.raster_chrome()
-        self.draw()
+        with self.lock:
+            new_tab = Tab(self, self.tab_height)
+            self.tabs.append(new_tab)
+            self.set_active_tab(new_tab)
+            self.run_in_tab(new_tab.load, url)
+            self.raster_chrome()
+
+class TileCache:
+    def __init__(self, max_tiles=MAX_TILES):
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+
+    def get(self, col, row, display_list):
+        key = (col, row)
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        surface = skia.Surface(TILE_SIZE, TILE_SIZE)
+        canvas = surface.getCanvas()
+        canvas.clear(skia.ColorWHITE)
+        canvas.save()
+        canvas.translate(-col * TILE_SIZE, -row * TILE_SIZE)
+        left = col * TILE_SIZE - TILE_PADDING
+        right = (col + 1) * TILE_SIZE + TILE_PADDING
+        top = row * TILE_SIZE - TILE_PADDING
+        bottom = (row + 1) * TILE_SIZE + TILE_PADDING
+        display_list.draw(canvas, skia.Rect.MakeLTRB(left, top, right, bottom))
+        canvas.restore()
+        self.tiles[key] = surface
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return surface
+
+    def invalidate(self, rect):
+        first_col = int((rect.left() - TILE_PADDING) // TILE_SIZE)
+        last_col = int((rect.right() + TILE_PADDING) // TILE_SIZE)
+        first_row = int((rect.top() - TILE_PADDING) // TILE_SIZE)
+        last_row = int((rect.bottom() + TILE_PADDING) // TILE_SIZE)
+        if (last_col - first_col + 1) * (last_row - first_row + 1) > len(self.tiles):
+            for col, row in list(self.tiles):
+                if first_col <= col <= last_col and first_row <= row <= last_row:
+                    del self.tiles[(col, row)]
+            return
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                self.tiles.pop((col, row), None)
+
+    def clear(self):
+        self.tiles.clear()
+
+class DisplayList(list):
+    # Commands stay in paint order; a separate index sorted by top edge,
+    # with the running maximum bottom, finds the ones overlapping a
+    # vertical range by bisection. Very tall commands (page backgrounds)
+    # would make that running maximum useless, so they are kept aside
+    # and checked directly, as are destination-in clips, which erase
+    # everything outside their own rect.
+    def __init__(self, cmds=()):
+        super().__init__(cmds)
+        self.indexed = None
+
+    def build_index(self):
+        self.tall = []
+        short = []
+        self.max_bottom = 0
+        for i, cmd in enumerate(self):
+            top, bottom = cmd.rect.top(), cmd.rect.bottom()
+            self.max_bottom = max(self.max_bottom, bottom)
+            if bottom - top > TALL_COMMAND or clips_outside(cmd):
+                self.tall.append(i)
+            else:
+                short.append((top, bottom, i))
+        short.sort()
+        self.tops = [top for top, _, _ in short]
+        self.bottoms = [bottom for _, bottom, _ in short]
+        self.order = [i for _, _, i in short]
+        self.reach = []
+        furthest = float("-inf")
+        for bottom in self.bottoms:
+            furthest = max(furthest, bottom)
+            self.reach.append(furthest)
+        self.indexed = len(self)
+
+    @property
+    def bottom(self):
+        if self.indexed != len(self):
+            self.build_index()
+        return self.max_bottom
+
+    def query(self, top, bottom):
+        # Commands overlapping [top, bottom], in paint order
+        if self.indexed != len(self):
+            self.build_index()
+        hits = [i for i in self.tall if clips_outside(self[i])
+            or self[i].rect.top() <= bottom and self[i].rect.bottom() >= top]
+        for j in range(bisect.bisect_right(self.tops, bottom) - 1, -1, -1):
+            if self.reach[j] < top:
+                break
+            if self.bottoms[j] >= top:
+                hits.append(self.order[j])
+        hits.sort()
+        return [self[i] for i in hits]
+
+    def draw(self, canvas, rect):
+        for cmd in self.query(rect.top(), rect.bottom()):
+            if clips_outside(cmd):
+                cmd.execute(canvas)
+                continue
+            if cmd.rect.left() > rect.right() or cmd.rect.right() < rect.left():
+                continue
+            if isinstance(cmd, (Blend, Opacity)):
+                cmd.execute(canvas, rect)
+            else:
+                cmd.execute(canvas)
+
+class LayerCache:
+    # Effect groups (translucent, blended or clipped subtrees) rasterized
+    # once into their own images, which every tile they touch blends in.
+    # Entries are keyed by content, so they survive renders that leave
+    # the subtree alone.
+    def __init__(self, max_pixels=LAYER_CACHE_PIXELS):
+        self.max_pixels = max_pixels
+        self.pixels = 0
+        self.layers = OrderedDict()
+
+    def draw(self, cmd, canvas, paint):
+        # Layers sit on whole pixels so blending them in is exact
+        left = math.floor(cmd.rect.left()) - LAYER_PADDING
+        top = math.floor(cmd.rect.top()) - LAYER_PADDING
+        width = math.ceil(cmd.rect.right()) + LAYER_PADDING - left
+        height = math.ceil(cmd.rect.bottom()) + LAYER_PADDING - top
+        if cmd.rect.isEmpty() or width * height > MAX_LAYER_PIXELS:
+            return False
+        key = content_key(cmd)
+        if key in self.layers:
+            self.layers.move_to_end(key)
+            image = self.layers[key]
+        else:
+            surface = skia.Surface(width, height)
+            layer_canvas = surface.getCanvas()
+            layer_canvas.clear(skia.ColorTRANSPARENT)
+            layer_canvas.translate(-left, -top)
+            for child in cmd.children:
+                child.execute(layer_canvas)
+            image = surface.makeImageSnapshot()
+            self.layers[key] = image
+            self.pixels += width * height
+            while self.pixels > self.max_pixels and len(self.layers) > 1:
+                _, old = self.layers.popitem(last=False)
+                self.pixels -= old.width() * old.height()
+        canvas.drawImage(image, left, top, paint=paint)
+        return True
+
+LAYER_CACHE = LayerCache()
+
+def content_key(cmd):
+    # Everything that decides a command's pixels, subtree included
+    if not hasattr(cmd, "children"):
+        return cmd.signature()
+    if cmd.key is None:
+        cmd.key = (cmd.signature(),
+            tuple(content_key(child) for child in cmd.children))
+    return cmd.key
+
+def clips_outside(cmd):
+    return isinstance(cmd, Blend) and cmd.blend_mode == "destination-in"
+
+def display_list_signatures(display_list, out):
+    for cmd in display_list:
+        out.append(cmd.signature())
+        if hasattr(cmd, "children"):
+            display_list_signatures(cmd.children, out)
+    return out
+
+def display_list_damage(old, new):
+    # Commands that only appear in one of the two lists mark the regions
+    # whose pixels changed
+    before = Counter(display_list_signatures(old, []))
+    after = Counter(display_list_signatures(new, []))
+    changed = (before - after) + (after - before)
+    return [skia.Rect.MakeLTRB(*signature[:4]) for signature in changed]
+
+class PageState:
+    def __init__(self, tab):
+        self.url = tab.url
+        self.nodes = tab.nodes
+        self.rules = tab.rules
+        self.rule_index = tab.rule_index
+        self.js = tab.js
+        self.allowed_origins = tab.allowed_origins
+        self.focus = tab.focus
+        self.document = tab.document
+        self.display_list = tab.display_list
+        self.scroll = tab.scroll
+        self.width = tab.width
+        self.size = len(tree_to_list(tab.nodes, []))
+
+class BackForwardCache:
+    def __init__(self, max_pages=BFCACHE_MAX_PAGES, max_nodes=BFCACHE_MAX_NODES):
+        self.max_pages = max_pages
+        self.max_nodes = max_nodes
+        self.pages = OrderedDict()
+        self.nodes = 0
+
+    def put(self, url, state):
+        old = self.take(url)
+        if old and old.js is not state.js:
+            old.js.discard()
+        self.pages[url] = state
+        self.nodes += state.size
+        self.trim(self.max_pages, self.max_nodes)
+
+    def take(self, url):
+        state = self.pages.pop(url, None)
+        if state:
+            self.nodes -= state.size
+        return state
+
+    def discard(self, url):
+        state = self.take(url)
+        if state:
+            state.js.discard()
+
+    def trim(self, max_pages, max_nodes):
+        # Evict the least recently stored pages first
+        while self.pages and \
+                (len(self.pages) > max_pages or self.nodes > max_nodes):
+            _, state = self.pages.popitem(last=False)
+            self.nodes -= state.size
+            state.js.discard()
+
+class Task:
+    def __init__(self, task_code, *args):
+        self.task_code = task_code
+        self.args = args
+
+    def run(self):
+        self.task_code(*self.args)
+        self.task_code = None
+        self.args = None
+
+class TaskRunner:
+    # Runs a tab's tasks in order on the tab's own thread. Once the queue
+    # is empty it runs the pending animation frame, which commits the
+    # results of all of them to the browser.
+    def __init__(self, tab):
+        self.tab = tab
+        self.tasks = deque()
+        self.frame = None
+        self.condition = threading.Condition()
+        self.needs_quit = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start_thread(self):
+        self.thread.start()
+
+    def schedule_task(self, task):
+        with self.condition:
+            self.tasks.append(task)
+            self.condition.notify_all()
+
+    def schedule_animation_frame(self, task):
+        with self.condition:
+            self.frame = task
+            self.condition.notify_all()
+
+    def set_needs_quit(self):
+        with self.condition:
+            self.needs_quit = True
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.tasks and not self.frame and not self.needs_quit:
+                    self.condition.wait()
+                if self.needs_quit:
+                    return
+                if self.tasks:
+                    task = self.tasks.popleft()
+                    is_frame = False
+                else:
+                    task = self.frame
+                    self.frame = None
+                    is_frame = True
+            try:
+                task.run()
+            except Exception:
+                traceback.print_exc()
+            if not is_frame:
+                self.tab.browser.set_needs_animation_frame(self.tab)
+
+class CommitData:
+    def __init__(self, url, title, history, scroll, scroll_serial, height,
+                 display_list, damage, clipboard):
+        self.url = url
+        self.title = title
+        self.history = history
+        self.scroll = scroll
+        self.scroll_serial = scroll_serial
+        self.height = height
+        self.display_list = display_list
+        self.damage = damage
+        self.clipboard = clipboard
 
 class Tab:
-    def __init__(self, tab_height):
+    def __init__(self, browser, tab_height):
+        self.browser = browser
         self.tab_height = tab_height
         self.history = []
         self.forward_history = []
@@ -692,15 +1371,34 @@ class Tab:
         self.focus = None
         self.url = None
         self.allowed_origins = None
-        self.scrolling = False
+        self.scroll_serial = 0
+        self.clipboard = None
+        self.bfcache = BackForwardCache()
+        self.styled_rules = None
+        self.needs_render = False
+        self.needs_raf_callbacks = False
+        self.document = None
+        self.layout_objects = None
+        self.display_list = DisplayList()
+        # Page-space rects repainted since the last commit; None means the
+        # whole tab changed
+        self.damage = None
+        self.task_runner = TaskRunner(self)
+        self.task_runner.start_thread()
 
     def load(self, url, payload=None, from_navigation=False):
         if not from_navigation:
+            for entry in self.forward_history:
+                self.bfcache.discard(entry)
             self.forward_history.clear()
-        headers, body = url.request(self.url, payload)
+            self.save_page()
+        parser = HTMLParser()
+        headers, body = url.request(self.url, payload, stream=parser.feed)
         self.history.append(url)
         self.url = url
-        self.nodes = HTMLParser(body).parse()
+        self.scroll_to(0)
+        self.nodes = parser.finish()
+        self.damage = None
         rules = DEFAULT_STYLE_SHEET.copy()
 
         if "content-security-policy" in headers:
@@ -713,6 +1411,9 @@ class Tab:
                     else:
                         self.allowed_origins.append(URL(origin).origin())
 
+        # Start every stylesheet and script download up front; results are
+        # consumed below in document order.
+        stylesheets = []
         for node in tree_to_list(self.nodes, []):
             if isinstance(node, Element):
                 # Handle external CSS files linked via <link>
@@ -723,10 +1424,9 @@ class Tab:
                         style_url = url.resolve(node.attributes["href"])
                         if not self.allowed_request(style_url):
                             continue
-                        header, body = style_url.request(url)
-                        rules.extend(CSSParser(body).parse())
                     except:
                         continue
+                    stylesheets.append(FETCH_POOL.submit(style_url.request, url))
                 
                 # Handle internal CSS blocks inside <style>
                 elif node.tag == "style":
@@ -735,7 +1435,7 @@ class Tab:
                         if isinstance(child, Text):
                             style_content += child.text
                     if style_content:
-                        rules.extend(CSSParser(style_content).parse())
+                        stylesheets.append(style_content)
 
                 # Handle textarea input
                 elif node.tag == "textarea":
@@ -752,20 +1452,35 @@ class Tab:
                    if isinstance(node, Element)
                    and node.tag == "script"
                    and "src" in node.attributes]
-        
-        self.js = JSContext(self)
+
+        script_fetches = []
         for script in scripts:
             script_url = url.resolve(script)
             if not self.allowed_request(script_url):
                 continue
+            script_fetches.append(
+                (script_url, FETCH_POOL.submit(script_url.request, url)))
+
+        for sheet in stylesheets:
+            if isinstance(sheet, str):
+                rules.extend(CSSParser(sheet).parse())
+                continue
+            try:
+                header, body = sheet.result()
+                rules.extend(CSSParser(body).parse())
+            except:
+                continue
+        
+        self.js = JSContext(self, parser.index)
+        for script_url, fetch in script_fetches:
             try:
-                header, body = script_url.request(url)
+                header, body = fetch.result()
             except:
                 continue
             self.js.run(script_url, body)
         
-        self.rules = rules
-        self.render()
+        self.rules = sorted(rules, key=cascade_priority)
+        self.set_needs_render()
         self.scroll_to_fragment()
 
     def allowed_request(self, target_url):
@@ -776,22 +1491,91 @@ class Tab:
     def scroll_to_fragment(self):
         if not self.url.fragment:
             return
-        
+        self.render()
         for node in tree_to_list(self.nodes, []):
             if isinstance(node, Element) and node.attributes.get("id") == self.url.fragment:
-                # Find the layout object for this node
-                for obj in tree_to_list(self.document, []):
-                    if hasattr(obj, 'node') and obj.node == node:
-                        self.scroll = obj.y
-                        return
+                obj = self.layout_object_for(node)
+                if obj:
+                    self.scroll_to(obj.y)
                 break
 
+    def layout_object_for(self, node):
+        # First layout object for each node, rebuilt after each layout pass
+        if self.layout_objects is None:
+            self.layout_objects = {}
+            for obj in tree_to_list(self.document, []):
+                self.layout_objects.setdefault(obj.node, obj)
+        return self.layout_objects.get(node)
+
+    def set_needs_render(self):
+        self.needs_render = True
+
     def render(self):
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes, self.width)
+        # Changes only mark the tab as needing a render; it happens once,
+        # before the next commit or anything that needs up-to-date layout
+        if not self.needs_render:
+            return
+        self.needs_render = False
+        # The rules are sorted once per page load; a different rule list
+        # than the one the tree was last styled with restyles everything.
+        if self.rules is not self.styled_rules:
+            self.rule_index = RuleIndex(self.rules)
+            style(self.nodes, self.rule_index, force=True)
+            self.styled_rules = self.rules
+        else:
+            style(self.nodes, self.rule_index)
+        # Layout objects are kept between renders so that clean subtrees
+        # can be reused; a new page or a resize starts from scratch.
+        if not self.document or self.document.node is not self.nodes:
+            self.document = DocumentLayout(self.nodes, self.width)
         self.document.layout()
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
+        self.layout_objects = None
+        old_display_list = self.display_list
+        display_list = []
+        paint_tree(self.document, display_list)
+        self.display_list = optimize_display_list(display_list)
+        if self.damage is not None:
+            self.damage.extend(
+                display_list_damage(old_display_list, self.display_list))
+
+    def invalidate(self):
+        self.damage = None
+
+    def request_animation_frame_callback(self):
+        self.needs_raf_callbacks = True
+        self.browser.set_needs_animation_frame(self)
+
+    def run_animation_frame(self, timestamp):
+        if self.needs_raf_callbacks:
+            self.needs_raf_callbacks = False
+            self.js.run_animation_frame_callbacks(timestamp)
+        self.render()
+        self.commit()
+
+    def commit(self):
+        damage = self.damage
+        self.damage = []
+        clipboard = self.clipboard
+        self.clipboard = None
+        self.browser.commit(self, CommitData(
+            self.url,
+            self.get_title() if hasattr(self, "nodes") else None,
+            (len(self.history) > 1, len(self.forward_history) > 0),
+            self.scroll, self.scroll_serial,
+            self.document.height if self.document else 0,
+            self.display_list, damage, clipboard))
+
+    def scroll_to(self, scroll):
+        # Scroll changes made by the page itself, which the browser has
+        # to pick up on the next commit
+        self.scroll = scroll
+        self.scroll_serial += 1
+
+    def set_scroll(self, scroll, serial):
+        # Scrolling done in the browser; dropped if the page has moved
+        # itself since the browser last heard from it
+        if serial == self.scroll_serial:
+            self.scroll = scroll
 
     def get_title(self):
         for node in tree_to_list(self.nodes, []):
@@ -805,113 +1589,71 @@ class Tab:
             current = self.history.pop()
             self.forward_history.append(current)
             back = self.history.pop()
-            self.load(back, from_navigation=True)
+            self.save_page()
+            if not self.restore_page(back):
+                self.load(back, from_navigation=True)
 
     def go_forward(self):
         if len(self.forward_history) > 0:
             forward = self.forward_history.pop()
-            self.load(forward, from_navigation=True)
+            self.save_page()
+            if not self.restore_page(forward):
+                self.load(forward, from_navigation=True)
+
+    def save_page(self):
+        if self.url and hasattr(self, "nodes"):
+            self.bfcache.put(self.url, PageState(self))
+
+    def restore_page(self, url):
+        state = self.bfcache.take(url)
+        if not state:
+            return False
+        self.history.append(url)
+        self.url = state.url
+        self.nodes = state.nodes
+        self.rules = state.rules
+        self.rule_index = state.rule_index
+        self.styled_rules = state.rules
+        self.js = state.js
+        self.js.resume()
+        self.allowed_origins = state.allowed_origins
+        self.focus = state.focus
+        self.document = state.document
+        self.display_list = state.display_list
+        self.layout_objects = None
+        self.scroll_to(state.scroll)
+        self.damage = None
+        if state.width != self.width:
+            self.resize(self.width, self.tab_height)
+        return True
 
     def reload(self):
         if not self.url:
             return
+        self.bfcache.discard(self.url)
         # Avoid duplicating the current entry in history on reload
         if self.history and self.history[-1] is self.url:
             self.history.pop()
         self.load(self.url, from_navigation=True)
 
-    def draw(self, canvas, offset):
-        canvas.save()
-        canvas.translate(0, offset)
-        canvas.clipRect(skia.Rect.MakeLTRB(0, 0, self.width, self.tab_height))
-        for cmd in self.display_list:
-            if cmd.rect.top() > self.scroll + self.tab_height: continue
-            if cmd.rect.bottom() < self.scroll: continue
-            cmd.execute(self.scroll, canvas)
-        
-        self.draw_scrollbar(canvas, 0)
-        canvas.restore()
-
-    def draw_scrollbar(self, canvas, offset):
-        if not self.display_list:
-            return
-            
-        content_height = self.display_list[-1].bottom + VSTEP
-        if content_height <= self.tab_height:
-            return
-            
-        scrollbar_width = 12
-        scrollbar_height = (self.tab_height / content_height) * self.tab_height
-        scrollbar_y = (self.scroll / content_height) * self.tab_height + offset
-        
-        rect = skia.Rect.MakeLTRB(
-            self.width - scrollbar_width, scrollbar_y,
-            self.width, scrollbar_y + scrollbar_height)
-        paint = skia.Paint(Color=skia.ColorBLUE)
-        canvas.drawRect(rect, paint)
-
-    def scrolldown(self):
-        max_y = max(self.document.height + 2*VSTEP - self.tab_height, 0)
-        self.scroll = min(self.scroll + SCROLL_STEP, max_y)
-
-    def scrollup(self):
-        if not self.scroll <= 0:
-            self.scroll -= SCROLL_STEP
-
-    def mousewheel(self, e):
-        if not self.display_list:
-            return
-        if e.y > 0:
-            self.scrollup()
-        elif e.y < 0:
-            self.scrolldown()
-
     def resize(self, width, height):
         self.width = width
         self.tab_height = height
         if hasattr(self, 'nodes'):
-            self.document = DocumentLayout(self.nodes, self.width)
-            self.document.layout()
-            self.display_list = []
-            paint_tree(self.document, self.display_list)
-
-    def mousedown(self, x, y):
-        if not self.display_list: return
-        content_height = self.display_list[-1].bottom + VSTEP
-        if content_height <= self.tab_height: return
-        
-        scrollbar_width = 12
-        scrollbar_height = (self.tab_height / content_height) * self.tab_height
-        scrollbar_y = (self.scroll / content_height) * self.tab_height
-        
-        if self.width - scrollbar_width <= x <= self.width:
-            if scrollbar_y <= y <= scrollbar_y + scrollbar_height:
-                self.scrolling = True
-                self.scroll_start_y = y
-                self.scroll_start_scroll = self.scroll
-
-    def mousemotion(self, x, y):
-        if self.scrolling:
-            content_height = self.display_list[-1].bottom + VSTEP
-            dy = y - self.scroll_start_y
-            scroll_dy = dy * (content_height / self.tab_height)
-            self.scroll = self.scroll_start_scroll + scroll_dy
-            
-            max_y = max(content_height - self.tab_height, 0)
-            self.scroll = max(0, min(self.scroll, max_y))
+            # A new layout tree rather than reflowing the old one
+            self.document = None
+            self.damage = None
+            self.set_needs_render()
 
     def click(self, x, y):
-        if self.scrolling:
-            self.scrolling = False
-            return
+        self.render()
         if self.focus:
             self.focus.is_focused = False
-        y += self.scroll
 
-        objs = [obj for obj in tree_to_list(self.document, []) if obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height]
+        obj = hit_test(self.document, x, y)
 
-        if not objs: return
-        elt = objs[-1].node
+        if not obj: return
+        elt = obj.node
         while elt:
             if isinstance(elt, Text):
                 pass
@@ -932,7 +1674,7 @@ class Tab:
                     elt.cursor = len(elt.attributes.get("value", ""))
                 elt.selection_start = None
                 elt.selection_end = None
-                return self.render()
+                return self.set_needs_render()
             elif elt.tag == "button":
                 self.js.dispatch_event("click", elt)
                 current = elt
@@ -941,7 +1683,7 @@ class Tab:
                         return self.submit_form(current)
                     current = current.parent
             elt = elt.parent if elt.parent else None
-        self.render()
+        self.set_needs_render()
 
     def key_press(self, char):
         if self.focus:
@@ -949,21 +1691,21 @@ class Tab:
             self.delete_selection(self.focus)
             value = self.focus.attributes.get("value", "")
             cursor = getattr(self.focus, "cursor", len(value))
-            self.focus.attributes["value"] = value[:cursor] + char + value[cursor:]
+            self.set_value(self.focus, value[:cursor] + char + value[cursor:])
             self.focus.cursor = cursor + 1
-            self.render()
+            self.set_needs_render()
 
     def backspace(self):
         if self.focus:
             if self.delete_selection(self.focus):
-                self.render()
+                self.set_needs_render()
                 return
             value = self.focus.attributes.get("value", "")
             cursor = getattr(self.focus, "cursor", len(value))
             if cursor > 0:
-                self.focus.attributes["value"] = value[:cursor-1] + value[cursor:]
+                self.set_value(self.focus, value[:cursor-1] + value[cursor:])
                 self.focus.cursor = cursor - 1
-                self.render()
+                self.set_needs_render()
 
     def arrow_left(self, mod):
         if self.focus:
@@ -978,7 +1720,7 @@ class Tab:
                 else:
                     self.focus.selection_start = None
                     self.focus.selection_end = None
-                self.render()
+                self.set_needs_render()
 
     def arrow_right(self, mod):
         if self.focus:
@@ -993,12 +1735,16 @@ class Tab:
                 else:
                     self.focus.selection_start = None
                     self.focus.selection_end = None
-                self.render()
+                self.set_needs_render()
 
     def enter(self):
         if self.focus:
              pass
 
+    def set_value(self, elt, value):
+        elt.attributes["value"] = value
+        self.js.attribute_changed(elt)
+
     def delete_selection(self, elt):
         start_sel = getattr(elt, "selection_start", None)
         end_sel = getattr(elt, "selection_end", None)
@@ -1006,7 +1752,7 @@ class Tab:
             start = min(start_sel, end_sel)
             end = max(start_sel, end_sel)
             value = elt.attributes.get("value", "")
-            elt.attributes["value"] = value[:start] + value[end:]
+            self.set_value(elt, value[:start] + value[end:])
             elt.cursor = start
             elt.selection_start = None
             elt.selection_end = None
@@ -1021,25 +1767,22 @@ class Tab:
                 start = min(start_sel, end_sel)
                 end = max(start_sel, end_sel)
                 value = self.focus.attributes.get("value", "")
-                sdl2.SDL_SetClipboardText(value[start:end].encode())
+                self.clipboard = value[start:end]
 
-    def paste(self):
+    def paste(self, text):
         if self.focus:
-            text = sdl2.SDL_GetClipboardText()
-            if not text: return
-            text = text.decode('utf8')
             self.delete_selection(self.focus)
             value = self.focus.attributes.get("value", "")
             cursor = getattr(self.focus, "cursor", len(value))
-            self.focus.attributes["value"] = value[:cursor] + text + value[cursor:]
+            self.set_value(self.focus, value[:cursor] + text + value[cursor:])
             self.focus.cursor = cursor + len(text)
-            self.render()
+            self.set_needs_render()
 
     def cut(self):
         if self.focus:
             self.copy()
             self.delete_selection(self.focus)
-            self.render()
+            self.set_needs_render()
 
     def submit_form(self, elt):
         if self.js.dispatch_event("submit", elt): return
@@ -1059,25 +1802,88 @@ class Tab:
         self.load(url, payload=body)
 
 FONTS = {}
+SIZED_FONTS = {}
+COLORS = OrderedDict()
+PAINTS = OrderedDict()
+TEXT_WIDTHS = OrderedDict()
+TEXT_GLYPHS = OrderedDict()
+FONT_METRICS = {}
+MEASURE_STATS = {"hits": 0, "misses": 0}
+# Tab threads lay out text while the browser thread rasters it, and both
+# go through these caches
+FONT_CACHE_LOCK = threading.Lock()
+COLOR_CACHE_LOCK = threading.Lock()
 
 def get_font(weight, style, size):
-    key = (weight, style)
-    if key not in FONTS:
-        if weight == "bold":
-            skia_weight = skia.FontStyle.kBold_Weight
+    sized_key = (weight, style, size)
+    font = SIZED_FONTS.get(sized_key)
+    if font is not None:
+        return font
+    with FONT_CACHE_LOCK:
+        if sized_key in SIZED_FONTS:
+            return SIZED_FONTS[sized_key]
+        key = (weight, style)
+        if key not in FONTS:
+            if weight == "bold":
+                skia_weight = skia.FontStyle.kBold_Weight
+            else:
+                skia_weight = skia.FontStyle.kNormal_Weight
+            if style == "italic":
+                skia_style = skia.FontStyle.kItalic_Slant
+            else:
+                skia_style = skia.FontStyle.kUpright_Slant
+            skia_width = skia.FontStyle.kNormal_Width
+            style_info = skia.FontStyle(skia_weight, skia_width, skia_style)
+            font = skia.Typeface('Arial', style_info)
+            FONTS[key] = font
+        SIZED_FONTS[sized_key] = skia.Font(FONTS[key], size)
+        return SIZED_FONTS[sized_key]
+
+def measure_text(font, text):
+    # get_font hands out a single Font per (typeface, size) that lives as
+    # long as the program, so its id() stands in for that pair.
+    key = (id(font), text)
+    with FONT_CACHE_LOCK:
+        width = TEXT_WIDTHS.get(key)
+        if width is None:
+            MEASURE_STATS["misses"] += 1
+            width = font.measureText(text)
+            TEXT_WIDTHS[key] = width
+            if len(TEXT_WIDTHS) > MEASURE_CACHE_SIZE:
+                TEXT_WIDTHS.popitem(last=False)
+        else:
+            MEASURE_STATS["hits"] += 1
+            TEXT_WIDTHS.move_to_end(key)
+    return width
+
+def shape_text(font, text):
+    # Glyph ids and their offsets from the start of the text; shared by
+    # every run that draws this word, so pages reuse it across renders
+    key = (id(font), text)
+    with FONT_CACHE_LOCK:
+        shaped = TEXT_GLYPHS.get(key)
+        if shaped is None:
+            glyphs = font.textToGlyphs(text)
+            shaped = TEXT_GLYPHS[key] = (glyphs, font.getXPos(glyphs))
+            if len(TEXT_GLYPHS) > MEASURE_CACHE_SIZE:
+                TEXT_GLYPHS.popitem(last=False)
         else:
-            skia_weight = skia.FontStyle.kNormal_Weight
-        if style == "italic":
-            skia_style = skia.FontStyle.kItalic_Slant
+            TEXT_GLYPHS.move_to_end(key)
+    return shaped
+
+def font_metrics(font):
+    with FONT_CACHE_LOCK:
+        metrics = FONT_METRICS.get(id(font))
+        if metrics is None:
+            MEASURE_STATS["misses"] += 1
+            metrics = FONT_METRICS[id(font)] = font.getMetrics()
         else:
-            skia_style = skia.FontStyle.kUpright_Slant
-        skia_width = skia.FontStyle.kNormal_Width
-        style_info = skia.FontStyle(skia_weight, skia_width, skia_style)
-        font = skia.Typeface('Arial', style_info)
-        FONTS[key] = font
-    return skia.Font(FONTS[key], size)
+            MEASURE_STATS["hits"] += 1
+    return metrics
 
 class DrawText:
+    __slots__ = ("top", "left", "text", "font", "color", "bottom", "rect",
+        "baseline", "paint")
     def __init__(self, x1, y1, text, font, color):
         self.top = y1
         self.left = x1
@@ -1087,36 +1893,81 @@ class DrawText:
         self.bottom = y1 + linespace(font)
         self.rect = skia.Rect.MakeLTRB(
             x1, y1,
-            x1 + font.measureText(text),
+            x1 + measure_text(font, text),
             self.bottom)
+        self.baseline = y1 - font_metrics(font).fAscent
+        self.paint = get_paint(color, antialias=True)
 
-    def execute(self, scroll, canvas):
-        paint = skia.Paint(
-            AntiAlias=True,
-            Color=parse_color(self.color),
-        )
-        baseline = self.rect.top() - scroll - self.font.getMetrics().fAscent
-        canvas.drawString(self.text, float(self.rect.left()),
-            baseline, self.font, paint)
+    def signature(self):
+        return rect_key(self.rect) + ("text", self.text, self.color, id(self.font))
+
+    def execute(self, canvas):
+        canvas.drawString(self.text, self.rect.left(),
+            self.baseline, self.font, self.paint)
     
+class DrawTextRun:
+    # A span of words in one font and color, drawn as a single text blob
+    __slots__ = ("words", "font", "color", "top", "bottom", "rect",
+        "baseline", "paint", "blob")
+    def __init__(self, y1, words, font, color):
+        self.words = words
+        self.font = font
+        self.color = color
+        self.top = y1
+        self.bottom = y1 + linespace(font)
+        last_x, last_text = words[-1]
+        self.rect = skia.Rect.MakeLTRB(
+            words[0][0], y1,
+            last_x + measure_text(font, last_text),
+            self.bottom)
+        self.baseline = y1 - font_metrics(font).fAscent
+        self.paint = get_paint(color, antialias=True)
+        self.blob = None
+
+    def signature(self):
+        return rect_key(self.rect) + \
+            ("textrun", tuple(self.words), self.color, id(self.font))
+
+    def make_blob(self):
+        glyphs = []
+        xpos = []
+        for x, text in self.words:
+            word_glyphs, offsets = shape_text(self.font, text)
+            glyphs.extend(word_glyphs)
+            xpos.extend([x + offset for offset in offsets])
+        builder = skia.TextBlobBuilder()
+        builder.allocRunPosH(self.font, glyphs, xpos, self.baseline)
+        return builder.make()
+
+    def execute(self, canvas):
+        if self.blob is None:
+            self.blob = self.make_blob()
+        if self.blob is not None:
+            canvas.drawTextBlob(self.blob, 0, 0, self.paint)
+
 class DrawRRect:
+    __slots__ = ("rect", "rrect", "radius", "color", "paint")
     def __init__(self, rect, radius, color):
         self.rect = rect
         self.rrect = skia.RRect.MakeRectXY(rect, radius, radius)
+        self.radius = radius
         self.color = color
+        self.paint = get_paint(color)
 
     @property
     def bottom(self):
         return self.rect.bottom()
 
-    def execute(self, scroll, canvas):
-        paint = skia.Paint(
-            Color=parse_color(self.color),
-        )
-        rrect = skia.RRect.MakeRectXY(self.rect.makeOffset(0, -scroll), self.rrect.radii(skia.RRect.kUpperLeft_Corner).x(), self.rrect.radii(skia.RRect.kUpperLeft_Corner).y())
-        canvas.drawRRect(rrect, paint)
+    def signature(self):
+        return rect_key(self.rect) + ("rrect", self.radius, self.color)
+
+    def execute(self, canvas):
+        canvas.drawRRect(self.rrect, self.paint)
 
 class BlockLayout:
+    __slots__ = ("node", "parent", "previous", "children", "x", "y",
+        "width", "height", "bounds", "hit_index", "cursor_x", "cursor_y",
+        "weight", "style", "size", "color")
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
@@ -1130,6 +1981,8 @@ class BlockLayout:
         self.style = "roman"
         self.size = 16
         self.color = "black"
+        self.bounds = None
+        self.hit_index = None
 
     def self_rect(self):
         return skia.Rect.MakeLTRB(self.x, self.y,
@@ -1137,24 +1990,44 @@ class BlockLayout:
 
     def layout(self):
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
-        self.x = self.parent.x
-        self.width = self.parent.width
+            y = self.parent.y
+        x = self.parent.x
+        width = self.parent.width
+
+        # Nothing under this node changed and the width is the same, so the
+        # previous layout is still valid; it may only need to move.
+        if not self.node.layout_dirty and width == self.width:
+            if x != self.x or y != self.y:
+                self.move(x - self.x, y - self.y)
+            return
+
+        self.x = x
+        self.y = y
+        self.width = width
+        self.node.layout_dirty = False
         mode = self.layout_mode()
         if mode == "block":
+            reusable = {child.node: child for child in self.children}
+            self.children = []
             previous = None
             for child in self.node.children:
                 if isinstance(child, Element) and child.tag in ["head", "script", "style", "title", "meta"]:
+                    clear_layout_dirty(child)
                     continue
-                next = BlockLayout(child, self, previous)
+                next = reusable.get(child)
+                if next:
+                    next.previous = previous
+                else:
+                    next = BlockLayout(child, self, previous)
                 self.children.append(next)
                 previous = next
             for child in self.children:
                 child.layout()
             self.height = sum([child.height for child in self.children])
         else:
+            self.children = []
             self.new_line()
             self.cursor_x = 0
             self.cursor_y = 0
@@ -1162,6 +2035,16 @@ class BlockLayout:
             for child in self.children:
                 child.layout()
             self.height = sum([child.height for child in self.children])
+        update_bounds(self)
+
+    def move(self, dx, dy):
+        for obj in tree_to_list(self, []):
+            obj.x += dx
+            obj.y += dy
+            if obj.bounds:
+                left, top, right, bottom = obj.bounds
+                obj.bounds = (left + dx, top + dy, right + dx, bottom + dy)
+                obj.hit_index = None
 
     def layout_mode(self):
         BLOCK_ELEMENTS = [
@@ -1184,6 +2067,7 @@ class BlockLayout:
 
     def recurse(self, node):
         if isinstance(node, Text):
+            node.layout_dirty = False
             if isinstance(self.node, Element) and self.node.tag == "pre":
                 lines = node.text.split("\n")
                 for i, line in enumerate(lines):
@@ -1196,10 +2080,14 @@ class BlockLayout:
                     self.word(node, word)
         else:
             if node.tag in ["script", "style", "head", "title", "meta"]:
+                clear_layout_dirty(node)
                 return
+            node.layout_dirty = False
             if node.tag == "br":
                 self.new_line()
             elif node.tag == "input" or node.tag == "button" or node.tag == "textarea":
+                for child in node.children:
+                    clear_layout_dirty(child)
                 self.input(node)
             else:
                 for child in node.children:
@@ -1212,7 +2100,7 @@ class BlockLayout:
         if style == "normal": style = "roman"
         size = parse_font_size(node.style["font-size"])
         font = get_font(weight, style, size)
-        w = font.measureText(word)
+        w = measure_text(font, word)
         if self.cursor_x + w > self.width and not (isinstance(self.node, Element) and self.node.tag == "pre"):
             self.new_line()
         line = self.children[-1]
@@ -1221,7 +2109,7 @@ class BlockLayout:
         line.children.append(text)
         self.cursor_x += w
         if not (isinstance(self.node, Element) and self.node.tag == "pre"):
-            self.cursor_x += font.measureText(" ")
+            self.cursor_x += measure_text(font, " ")
 
     def input(self, node):
         if node.tag == "input" and node.attributes.get("type", "").casefold() == "hidden":
@@ -1241,7 +2129,7 @@ class BlockLayout:
         input = InputLayout(node, line, previous_word, font)
         line.children.append(input)
 
-        self.cursor_x += w + font.measureText(" ")
+        self.cursor_x += w + measure_text(font, " ")
 
     def new_line(self):
         self.cursor_x = 0
@@ -1287,12 +2175,84 @@ def paint_tree(layout_object, display_list):
             
         display_list.extend(cmds)
 
+def layout_bounds(obj):
+    # Containers store the box around their whole subtree; leaves are
+    # just their own box
+    if obj.bounds:
+        return obj.bounds
+    return (obj.x, obj.y, obj.x + obj.width, obj.y + obj.height)
+
+def update_bounds(obj):
+    left, top = obj.x, obj.y
+    right, bottom = obj.x + obj.width, obj.y + obj.height
+    for child in obj.children:
+        child_left, child_top, child_right, child_bottom = layout_bounds(child)
+        left = min(left, child_left)
+        top = min(top, child_top)
+        right = max(right, child_right)
+        bottom = max(bottom, child_bottom)
+    obj.bounds = (left, top, right, bottom)
+    obj.hit_index = None
+
+class HitIndex:
+    def __init__(self, children):
+        # Children are laid out top to bottom (blocks, lines) or left to
+        # right (words in a line); bisect along whichever axis is sorted.
+        self.children = children
+        self.boxes = [layout_bounds(child) for child in children]
+        tops = [box[1] for box in self.boxes]
+        lefts = [box[0] for box in self.boxes]
+        if all(a <= b for a, b in zip(tops, tops[1:])):
+            self.axis = 1
+            self.starts = tops
+        elif all(a <= b for a, b in zip(lefts, lefts[1:])):
+            self.axis = 0
+            self.starts = lefts
+        else:
+            self.axis = None
+            return
+        # reach[i] is the furthest far edge among the first i+1 children
+        self.reach = []
+        furthest = float("-inf")
+        for box in self.boxes:
+            furthest = max(furthest, box[self.axis + 2])
+            self.reach.append(furthest)
+
+    def candidates(self, x, y):
+        # Children whose subtree contains the point, last painted first
+        if self.axis is None:
+            indices = range(len(self.children) - 1, -1, -1)
+        else:
+            p = y if self.axis == 1 else x
+            indices = range(bisect.bisect_right(self.starts, p) - 1, -1, -1)
+        for i in indices:
+            if self.axis is not None and self.reach[i] <= p:
+                break
+            left, top, right, bottom = self.boxes[i]
+            if left <= x < right and top <= y < bottom:
+                yield self.children[i]
+
+def hit_test(obj, x, y):
+    # The deepest, last-painted layout object containing the point, using
+    # each container's subtree bounds to skip everything else
+    if obj.children:
+        if obj.hit_index is None:
+            obj.hit_index = HitIndex(obj.children)
+        for child in obj.hit_index.candidates(x, y):
+            hit = hit_test(child, x, y)
+            if hit: return hit
+    if obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height:
+        return obj
+    return None
+
 class DocumentLayout:
     def __init__(self, node, width=WIDTH):
         self.node = node
         self.parent = None
         self.children = []
         self._width = width
+        self.bounds = None
+        self.hit_index = None
 
     def should_paint(self):
         return True
@@ -1301,10 +2261,12 @@ class DocumentLayout:
         self.x = HSTEP
         self.y = VSTEP
         self.width = self._width - 2*HSTEP
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        if not self.children:
+            self.children.append(BlockLayout(self.node, self, None))
+        child = self.children[0]
         child.layout()
         self.height = child.height
+        update_bounds(self)
 
     def paint(self):
         return []
@@ -1313,11 +2275,15 @@ class DocumentLayout:
         return cmds
     
 class LineLayout:
+    __slots__ = ("node", "parent", "previous", "children", "x", "y",
+        "width", "height", "bounds", "hit_index")
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
         self.previous = previous
         self.children = []
+        self.bounds = None
+        self.hit_index = None
 
     def should_paint(self):
         return True
@@ -1336,13 +2302,14 @@ class LineLayout:
 
         if not self.children:
             self.height = 0
+            update_bounds(self)
             return
 
-        max_ascent = max([-word.font.getMetrics().fAscent for word in self.children])
+        max_ascent = max([-font_metrics(word.font).fAscent for word in self.children])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline + word.font.getMetrics().fAscent
-        max_descent = max([word.font.getMetrics().fDescent for word in self.children])
+            word.y = baseline + font_metrics(word.font).fAscent
+        max_descent = max([font_metrics(word.font).fDescent for word in self.children])
 
         self.height = 1.25 * (max_ascent + max_descent)
 
@@ -1359,14 +2326,35 @@ class LineLayout:
             
         for word in self.children:
             word.x += offset
+        update_bounds(self)
 
     def paint(self):
-        return []
+        cmds = []
+        run = []
+        for child in self.children:
+            if not isinstance(child, TextLayout):
+                continue
+            if run and (child.font is not run[0].font or
+                    child.color != run[0].color):
+                cmds.append(text_run(run))
+                run = []
+            run.append(child)
+        if run:
+            cmds.append(text_run(run))
+        return cmds
 
     def paint_effects(self, cmds):
         return cmds
 
+def text_run(words):
+    first = words[0]
+    return DrawTextRun(first.y,
+        [(word.x, word.word) for word in words],
+        first.font, first.color)
+
 class TextLayout:
+    __slots__ = ("node", "word", "parent", "previous", "children", "font",
+        "color", "x", "y", "width", "height", "bounds")
     def __init__(self, node, word, parent, previous, font, color):
         self.node = node
         self.word = word
@@ -1375,14 +2363,15 @@ class TextLayout:
         self.children = []
         self.font = font
         self.color = color
+        self.bounds = None
 
     def should_paint(self):
         return True
 
     def layout(self):
-        self.width = self.font.measureText(self.word)
+        self.width = measure_text(self.font, self.word)
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = measure_text(self.previous.font, " ")
             if isinstance(self.parent.node, Element) and self.parent.node.tag == "pre":
                 space = 0
             self.x = self.previous.x + self.previous.width + space
@@ -1392,18 +2381,21 @@ class TextLayout:
         self.height = linespace(self.font)
 
     def paint(self):
-        return [DrawText(self.x, self.y, self.word, self.font, self.color)]
+        return []
 
     def paint_effects(self, cmds):
         return cmds
 
 class InputLayout:
+    __slots__ = ("node", "parent", "previous", "children", "font", "x", "y",
+        "width", "height", "bounds")
     def __init__(self, node, parent, previous, font):
         self.node = node
         self.parent = parent
         self.previous = previous
         self.children = []
         self.font = font
+        self.bounds = None
 
     def should_paint(self):
         return True
@@ -1415,7 +2407,7 @@ class InputLayout:
     def layout(self):
         self.width = INPUT_WIDTH_PX
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = measure_text(self.previous.font, " ")
             self.x = self.previous.x + self.previous.width + space
         else:
             self.x = self.parent.x
@@ -1449,12 +2441,12 @@ class InputLayout:
             if start_sel is not None and end_sel is not None:
                 start = min(start_sel, end_sel)
                 end = max(start_sel, end_sel)
-                start_x = self.x + self.font.measureText(text[:start])
-                end_x = self.x + self.font.measureText(text[:end])
+                start_x = self.x + measure_text(self.font, text[:start])
+                end_x = self.x + measure_text(self.font, text[:end])
                 cmds.append(DrawRRect(skia.Rect.MakeLTRB(start_x, self.y, end_x, self.y + self.height), 0, "lightblue"))
 
             cursor = getattr(self.node, "cursor", len(text))
-            cx = self.x + self.font.measureText(text[:cursor])
+            cx = self.x + measure_text(self.font, text[:cursor])
             cmds.append(DrawLine(
                 cx, self.y, cx, self.y + self.height, "black", 1))
 
@@ -1467,53 +2459,147 @@ class InputLayout:
         return cmds
     
 class Opacity:
+    __slots__ = ("opacity", "children", "rect", "key", "paint")
     def __init__(self, opacity, children):
         self.opacity = opacity
-        self.children = children
-        self.rect = skia.Rect.MakeEmpty()
-        for cmd in self.children:
-            self.rect.join(cmd.rect)
+        self.paint = skia.Paint(Alphaf=self.opacity)
+        self.children = DisplayList(children)
+        self.key = None
+        self.rect = effect_bounds(self.children)
 
     @property
     def bottom(self):
         return self.rect.bottom()
 
-    def execute(self, scroll, canvas):
-        paint = skia.Paint(Alphaf=self.opacity)
+    def signature(self):
+        return rect_key(self.rect) + ("opacity", self.opacity)
+
+    def is_identity(self):
+        return self.opacity >= 1.0
+
+    def with_children(self, children):
+        return Opacity(self.opacity, children)
+
+    def execute(self, canvas, rect=None):
+        if self.opacity < 1.0 and LAYER_CACHE.draw(self, canvas, self.paint):
+            return
         if self.opacity < 1.0:
-            canvas.saveLayer(None, paint)
-        for cmd in self.children:
-            cmd.execute(scroll, canvas)
+            canvas.saveLayer(None, self.paint)
+        if rect is not None:
+            self.children.draw(canvas, rect)
+        else:
+            for cmd in self.children:
+                cmd.execute(canvas)
         if self.opacity < 1:
             canvas.restore()
 
 class Blend:
+    __slots__ = ("opacity", "blend_mode", "should_save", "children", "rect",
+        "key", "paint")
     def __init__(self, opacity, blend_mode, children):
         self.blend_mode = blend_mode
         self.opacity = opacity
         self.should_save = self.blend_mode or self.opacity < 1
+        self.paint = skia.Paint(
+            Alphaf=self.opacity,
+            BlendMode=parse_blend_mode(self.blend_mode),
+        )
 
-        self.children = children
-        self.rect = skia.Rect.MakeEmpty()
-        for cmd in self.children:
-            self.rect.join(cmd.rect)
+        self.children = DisplayList(children)
+        self.key = None
+        self.rect = effect_bounds(self.children)
 
     @property
     def bottom(self):
         return self.rect.bottom()
 
-    def execute(self, scroll, canvas):
-        paint = skia.Paint(
-            Alphaf=self.opacity,
-            BlendMode=parse_blend_mode(self.blend_mode),
-        )
+    def signature(self):
+        return rect_key(self.rect) + ("blend", self.opacity, self.blend_mode)
+
+    def is_identity(self):
+        return not self.should_save
+
+    def with_children(self, children):
+        return Blend(self.opacity, self.blend_mode, children)
+
+    def execute(self, canvas, rect=None):
+        # Destination-in clips reach outside their own rect, which an
+        # image of the layer cannot
+        if self.should_save and not clips_outside(self) \
+                and LAYER_CACHE.draw(self, canvas, self.paint):
+            return
         if self.should_save:
-            canvas.saveLayer(None, paint)
-        for cmd in self.children:
-            cmd.execute(scroll, canvas)
+            canvas.saveLayer(None, self.paint)
+        if rect is not None:
+            self.children.draw(canvas, rect)
+        else:
+            for cmd in self.children:
+                cmd.execute(canvas)
         if self.should_save:
             canvas.restore()
 
+def effect_bounds(children):
+    # Everything drawn before a destination-in clip is cut down to it
+    rect = skia.Rect.MakeEmpty()
+    for cmd in children:
+        if clips_outside(cmd):
+            if not rect.intersect(cmd.rect):
+                rect = skia.Rect.MakeEmpty()
+        else:
+            rect.join(cmd.rect)
+    return rect
+
+def optimize_display_list(cmds):
+    # Splices out effect groups that change nothing and drops empty ones,
+    # so culling reaches the leaf commands, then merges runs of
+    # neighbouring groups with the same effect that do not overlap
+    out = []
+    run = []
+    run_rect = None
+    for cmd in flatten_effects(cmds):
+        if run and can_merge(run[0], cmd) and not skia.Rect.Intersects(run_rect, cmd.rect):
+            run.append(cmd)
+            run_rect.join(cmd.rect)
+            continue
+        merge_run(out, run)
+        if hasattr(cmd, "children") and not has_clip(cmd):
+            run = [cmd]
+            run_rect = skia.Rect.MakeLTRB(*rect_key(cmd.rect))
+        else:
+            run = []
+            out.append(cmd)
+    merge_run(out, run)
+    return DisplayList(out)
+
+def flatten_effects(cmds):
+    for cmd in cmds:
+        if not hasattr(cmd, "children"):
+            yield cmd
+            continue
+        children = optimize_display_list(cmd.children)
+        if not children:
+            continue
+        if cmd.is_identity():
+            yield from children
+        else:
+            yield cmd.with_children(children)
+
+def has_clip(cmd):
+    return clips_outside(cmd) or any(clips_outside(child) for child in cmd.children)
+
+def can_merge(group, cmd):
+    # Compositing disjoint groups one by one or as one layer gives the
+    # same pixels; clips would start erasing each other's content
+    return type(cmd) is type(group) and \
+        cmd.signature()[4:] == group.signature()[4:] and not has_clip(cmd)
+
+def merge_run(out, run):
+    if len(run) == 1:
+        out.append(run[0])
+    elif run:
+        out.append(run[0].with_children(
+            [child for group in run for child in group.children]))
+
 def parse_blend_mode(blend_mode_str):
     if blend_mode_str == "multiply":
         return skia.BlendMode.kMultiply
@@ -1539,11 +2625,46 @@ def paint_visual_effects(node, cmds, rect):
 
     return [Blend(opacity, blend_mode, cmds)]
 
+def rect_key(rect):
+    return (rect.left(), rect.top(), rect.right(), rect.bottom())
+
 def linespace(font):
-    metrics = font.getMetrics()
+    metrics = font_metrics(font)
     return metrics.fDescent - metrics.fAscent
     
 def parse_color(color):
+    with COLOR_CACHE_LOCK:
+        parsed = COLORS.get(color)
+        if parsed is not None:
+            COLORS.move_to_end(color)
+            return parsed
+    # Named colors parse through here again, so this runs unlocked
+    parsed = parse_color_string(color)
+    with COLOR_CACHE_LOCK:
+        COLORS[color] = parsed
+        if len(COLORS) > COLOR_CACHE_SIZE:
+            COLORS.popitem(last=False)
+    return parsed
+
+def get_paint(color, thickness=None, antialias=False):
+    # Paints are shared between draw commands and never modified
+    key = (color, thickness, antialias)
+    with COLOR_CACHE_LOCK:
+        paint = PAINTS.get(key)
+        if paint is not None:
+            PAINTS.move_to_end(key)
+            return paint
+    paint = skia.Paint(AntiAlias=antialias, Color=parse_color(color))
+    if thickness is not None:
+        paint.setStrokeWidth(thickness)
+        paint.setStyle(skia.Paint.kStroke_Style)
+    with COLOR_CACHE_LOCK:
+        PAINTS[key] = paint
+        if len(PAINTS) > COLOR_CACHE_SIZE:
+            PAINTS.popitem(last=False)
+    return paint
+
+def parse_color_string(color):
     if color.startswith("#"):
         if len(color) == 7:
             r = int(color[1:3], 16)
@@ -1577,46 +2698,62 @@ def parse_color(color):
     else:
         return skia.ColorBLACK
     
+def handle_event(browser, event):
+    if event.type == sdl2.SDL_QUIT:
+        browser.handle_quit()
+        sdl2.SDL_Quit()
+        sys.exit()
+    elif event.type == sdl2.SDL_MOUSEBUTTONUP:
+        browser.handle_click(event.button)
+    elif event.type == sdl2.SDL_MOUSEBUTTONDOWN:
+        browser.handle_mousedown(event.button)
+    elif event.type == sdl2.SDL_MOUSEMOTION:
+        browser.handle_mousemotion(event.motion)
+    elif event.type == sdl2.SDL_MOUSEWHEEL:
+        browser.handle_mousewheel(event.wheel)
+    elif event.type == sdl2.SDL_WINDOWEVENT:
+        if event.window.event == sdl2.SDL_WINDOWEVENT_SIZE_CHANGED:
+            browser.handle_configure(event.window.data1, event.window.data2)
+    elif event.type == sdl2.SDL_KEYDOWN:
+        if event.key.keysym.sym == sdl2.SDLK_RETURN:
+            browser.handle_enter()
+        elif event.key.keysym.sym == sdl2.SDLK_DOWN:
+            browser.handle_down()
+        elif event.key.keysym.sym == sdl2.SDLK_UP:
+            browser.handle_up()
+        elif event.key.keysym.sym == sdl2.SDLK_BACKSPACE:
+            browser.handle_backspace()
+        elif event.key.keysym.sym == sdl2.SDLK_LEFT:
+            browser.handle_left(event.key.keysym.mod)
+        elif event.key.keysym.sym == sdl2.SDLK_RIGHT:
+            browser.handle_right(event.key.keysym.mod)
+        elif event.key.keysym.sym == sdl2.SDLK_c and (event.key.keysym.mod & sdl2.KMOD_CTRL):
+            browser.handle_copy()
+        elif event.key.keysym.sym == sdl2.SDLK_v and (event.key.keysym.mod & sdl2.KMOD_CTRL):
+            browser.handle_paste()
+        elif event.key.keysym.sym == sdl2.SDLK_x and (event.key.keysym.mod & sdl2.KMOD_CTRL):
+            browser.handle_cut()
+    elif event.type == sdl2.SDL_TEXTINPUT:
+        browser.handle_key(event.text.text.decode('utf8'))
+
 def mainloop(browser):
+    # Sleep until there is input, a tab has committed a new frame, or a
+    # frame is due; then handle everything that arrived and draw at most
+    # once per refresh interval
     event = sdl2.SDL_Event()
+    next_frame = time.perf_counter()
     while True:
-        while sdl2.SDL_PollEvent(ctypes.byref(event)) != 0:
-            if event.type == sdl2.SDL_QUIT:
-                browser.handle_quit()
-                sdl2.SDL_Quit()
-                sys.exit()
-            elif event.type == sdl2.SDL_MOUSEBUTTONUP:
-                browser.handle_click(event.button)
-            elif event.type == sdl2.SDL_MOUSEBUTTONDOWN:
-                browser.handle_mousedown(event.button)
-            elif event.type == sdl2.SDL_MOUSEMOTION:
-                browser.handle_mousemotion(event.motion)
-            elif event.type == sdl2.SDL_MOUSEWHEEL:
-                browser.handle_mousewheel(event.wheel)
-            elif event.type == sdl2.SDL_WINDOWEVENT:
-                if event.window.event == sdl2.SDL_WINDOWEVENT_SIZE_CHANGED:
-                    browser.handle_configure(event.window.data1, event.window.data2)
-            elif event.type == sdl2.SDL_KEYDOWN:
-                if event.key.keysym.sym == sdl2.SDLK_RETURN:
-                    browser.handle_enter()
-                elif event.key.keysym.sym == sdl2.SDLK_DOWN:
-                    browser.handle_down()
-                elif event.key.keysym.sym == sdl2.SDLK_UP:
-                    browser.handle_up()
-                elif event.key.keysym.sym == sdl2.SDLK_BACKSPACE:
-                    browser.handle_backspace()
-                elif event.key.keysym.sym == sdl2.SDLK_LEFT:
-                    browser.handle_left(event.key.keysym.mod)
-                elif event.key.keysym.sym == sdl2.SDLK_RIGHT:
-                    browser.handle_right(event.key.keysym.mod)
-                elif event.key.keysym.sym == sdl2.SDLK_c and (event.key.keysym.mod & sdl2.KMOD_CTRL):
-                    browser.handle_copy()
-                elif event.key.keysym.sym == sdl2.SDLK_v and (event.key.keysym.mod & sdl2.KMOD_CTRL):
-                    browser.handle_paste()
-                elif event.key.keysym.sym == sdl2.SDLK_x and (event.key.keysym.mod & sdl2.KMOD_CTRL):
-                    browser.handle_cut()
-            elif event.type == sdl2.SDL_TEXTINPUT:
-                browser.handle_key(event.text.text.decode('utf8'))
+        if browser.needs_draw:
+            timeout = max(0, math.ceil((next_frame - time.perf_counter()) * 1000))
+        else:
+            timeout = IDLE_TIMEOUT_MS
+        if sdl2.SDL_WaitEventTimeout(ctypes.byref(event), timeout):
+            handle_event(browser, event)
+            while sdl2.SDL_PollEvent(ctypes.byref(event)) != 0:
+                handle_event(browser, event)
+        if browser.needs_draw and time.perf_counter() >= next_frame:
+            browser.raster_and_draw()
+            next_frame = time.perf_counter() + REFRESH_RATE_SEC
 
 if __name__ == '__main__':
     import sys